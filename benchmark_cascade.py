@@ -0,0 +1,65 @@
+import numpy as np
+import cv2
+import glob
+import time
+from profiler import PipelineProfiler
+from detect_vehicles import VehicleDetector
+from classify_vehicles import svm_model_path, scaler_model_path, cascade_model_path
+
+# Frames tracked, synthetic road frames if there are none
+img_files = sorted(glob.glob('test_images/*.jpg'))
+n_synthetic_frames = 40
+# Frames are tracked n_repeats times, the fastest pass is reported
+n_repeats = 3
+
+# Windows searched per second and fraction passing the first stage when tracking the frames with
+# track_vehicles, end to end from colour conversion to drawing, best of n_repeats passes
+def tracking_rate(classifier, frames):
+    best = 0.
+    for _ in range(n_repeats):
+        profiler = PipelineProfiler(enabled=True)
+        detector = VehicleDetector(profiler=profiler, **classifier)
+        t1 = time.time()
+        for frame in frames:
+            detector.track_vehicles(frame)
+        t2 = time.time()
+        summary = profiler.summary()
+        n_windows = len(frames) * sum(stats['mean'] for key, stats in summary.items()
+                                      if key.startswith('count/windows/'))
+        best = max(best, n_windows / (t2 - t1))
+    passed = summary['count/cascade_passed']['mean'] * len(frames) / n_windows \
+        if 'count/cascade_passed' in summary else 1.
+    return best, passed
+
+# Fraction of the windows detected by the single stage detector that the cascade also detects,
+# and the number of windows each detects
+def cascade_recall(single, two_stage, frames):
+    n_single = n_cascade = n_kept = 0
+    for frame in frames:
+        single_windows = set(single.detect_windows(frame))
+        cascade_windows = set(two_stage.detect_windows(frame))
+        n_single += len(single_windows)
+        n_cascade += len(cascade_windows)
+        n_kept += len(single_windows & cascade_windows)
+    return n_kept / max(1, n_single), n_single, n_cascade
+
+if __name__ == '__main__':
+    from sklearn.externals import joblib
+    svc = joblib.load(svm_model_path)
+    X_scaler = joblib.load(scaler_model_path)
+    cascade = joblib.load(cascade_model_path)
+    if img_files:
+        frames = [cv2.cvtColor(cv2.imread(img_file), cv2.COLOR_BGR2RGB) for img_file in img_files]
+    else:
+        from benchmark_detection import synthetic_frames
+        print('No frames in test_images/, using', n_synthetic_frames, 'synthetic frames')
+        frames, _ = synthetic_frames(n_synthetic_frames)
+    single_rate, _ = tracking_rate(dict(svc=svc, X_scaler=X_scaler), frames)
+    cascade_rate, passed = tracking_rate(dict(svc=svc, X_scaler=X_scaler, cascade=cascade), frames)
+    recall, n_single, n_cascade = cascade_recall(VehicleDetector(svc, X_scaler),
+                                                 VehicleDetector(svc, X_scaler, cascade=cascade), frames)
+    print('{} frames tracked end to end'.format(len(frames)))
+    print('Single stage: {:.0f} windows/s, {} detections'.format(single_rate, n_single))
+    print('Cascade: {:.0f} windows/s ({:.2f}x), {:.3f} of windows pass the first stage, {} detections'.format(
+        cascade_rate, cascade_rate / single_rate, passed, n_cascade))
+    print('Cascade recall against single stage: {:.4f}'.format(recall))
@@ -0,0 +1,206 @@
+import os
+import sys
+import glob
+import json
+import time
+import tracemalloc
+import numpy as np
+import cv2
+from profiler import PipelineProfiler
+from detect_vehicles import VehicleDetector, REGION_X1, REGION_Y1, REGION_X2, REGION_Y2
+from classify_vehicles import load_model, feature_params, model_path, svm_model_path, scaler_model_path, \
+    use_cascade, orient, pix_per_cell, cell_per_block, train_img_width
+
+# Directory of recorded frames replayed in name order, with optional labels in labels.json
+# mapping frame file names to lists of vehicle boxes [x1, y1, x2, y2]. Synthetic frames with
+# known vehicle boxes are used if the directory has no frames, for throughput only since their
+# box shaped vehicles say nothing of detection quality.
+frames_dir = 'test_images/test_video/'
+n_synthetic_frames = 40
+# Timed passes over the frames per configuration, the median FPS is reported and gated
+n_repeats = 5
+# Detector configurations compared, as VehicleDetector arguments on top of the defaults
+configs = [
+    ('default', {}),
+    ('coarse_steps', dict(cells_xstep_list=(4, 4, 4), cells_ystep_list=(4, 4, 4))),
+    ('two_scales', dict(scale_list=(2, 1.5), x_start_stop=((300, 1280), (400, 1280)),
+                        y_start_stop=((400, 700), (400, 560)), cells_xstep_list=(2, 2), cells_ystep_list=(2, 2))),
+    ('narrow_roi', dict(x_start_stop=((600, 1280), (600, 1280), (600, 1280)))),
+    ('short_history', dict(n_prev_frames=8, heat_thresh=4)),
+    ('roi_tracking', dict(roi_tracking=True)),
+    ('motion_gating', dict(motion_gating=True)),
+]
+# Median FPS of each configuration on this machine, written with --update-baseline. A configuration
+# more than regression_tolerance slower than its baseline fails the benchmark, and so does a
+# missing baseline.
+baseline_path = 'benchmark_baseline.json'
+regression_tolerance = 0.2
+# IoU above which a detected vehicle matches a labeled one
+iou_thresh = 0.5
+
+# Road-like frames with two box shaped vehicles moving across the search band, and their boxes
+def synthetic_frames(n, seed=0):
+    rng = np.random.RandomState(seed)
+    background = np.zeros((720, 1280, 3), dtype=np.uint8)
+    background[:400] = (135, 170, 210)
+    background[400:] = (90, 90, 90)
+    background = np.clip(background + rng.randint(-10, 11, background.shape), 0, 255).astype(np.uint8)
+    frames = []
+    labels = []
+    for i in range(n):
+        frame = background.copy()
+        cv2.line(frame, (0, 690 - i), (1280, 620 - i), (230, 230, 230), 6)
+        boxes = [(700 + 4 * i, 410, 796 + 4 * i, 490), (1000 - 3 * i, 420, 1160 - 3 * i, 540)]
+        for x1, y1, x2, y2 in boxes:
+            cv2.rectangle(frame, (x1, y1), (x2, y2), (40, 40, 160), -1)
+            cv2.rectangle(frame, (x1 + 10, y1 + 10), (x2 - 10, y1 + 30), (20, 20, 20), -1)
+        frames.append(frame)
+        labels.append(np.array(boxes))
+    return frames, labels
+
+# Recorded RGB frames and their labeled boxes, None for frames without labels
+def recorded_frames(frame_dir):
+    files = sorted(glob.glob(os.path.join(frame_dir, '*.jpg')) + glob.glob(os.path.join(frame_dir, '*.png')))
+    labels_path = os.path.join(frame_dir, 'labels.json')
+    frame_labels = {}
+    if os.path.exists(labels_path):
+        with open(labels_path) as f:
+            frame_labels = json.load(f)
+    frames = [cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB) for file in files]
+    labels = [np.array(frame_labels[os.path.basename(file)]).reshape(-1, 4)
+              if os.path.basename(file) in frame_labels else None for file in files]
+    return frames, labels
+
+# Classifier arguments of VehicleDetector and whether they are a trained model: the compact
+# model, else the pickled models, else a random linear model accepting about accept_fraction of
+# the windows of frame, so throughput can be measured without trained models
+def benchmark_classifier(frame, accept_fraction=0.05, seed=0):
+    if os.path.exists(model_path):
+        model = load_model(model_path, cascade=use_cascade)
+        return dict(model=model, svc_conf_thresh=model['threshold']), True
+    try:
+        from sklearn.externals import joblib
+        from classify_vehicles import svc_conf_thresh
+        return dict(svc=joblib.load(svm_model_path), X_scaler=joblib.load(scaler_model_path),
+                    svc_conf_thresh=svc_conf_thresh), True
+    except Exception as e:
+        print('No usable trained model ({}), using a random linear model'.format(e))
+    nwinblocks = train_img_width // pix_per_cell - cell_per_block + 1
+    n_features = 3 * nwinblocks * nwinblocks * cell_per_block * cell_per_block * orient
+    model = dict(weights=np.random.RandomState(seed).randn(n_features), bias=0., threshold=1.,
+                 params=feature_params())
+    features, _ = VehicleDetector(model=model).frame_candidates(frame)
+    scores = features.dot(model['weights'])
+    model['bias'] = model['threshold'] - np.percentile(scores, 100 * (1 - accept_fraction))
+    return dict(model=model, svc_conf_thresh=model['threshold']), False
+
+def box_iou(box, boxes):
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / (area + areas - intersection)
+
+# Greedily match detected to labeled boxes and return the number of true positives
+def count_matches(detected, labeled):
+    unmatched = np.ones(len(labeled), dtype=bool)
+    n_matched = 0
+    for box in detected:
+        if not unmatched.any():
+            break
+        iou = np.where(unmatched, box_iou(box, labeled), 0)
+        best = np.argmax(iou)
+        if iou[best] >= iou_thresh:
+            unmatched[best] = False
+            n_matched += 1
+    return n_matched
+
+# Replay the frames through track_vehicles with one configuration. Returns the median FPS of
+# n_repeats timed passes, windows per frame, peak traced memory in MB and precision and recall
+# over the labeled frames.
+def run_config(classifier, config, frames, labels):
+    fps = []
+    for _ in range(n_repeats):
+        profiler = PipelineProfiler(enabled=True)
+        detector = VehicleDetector(profiler=profiler, **dict(classifier, **config))
+        t1 = time.time()
+        for frame in frames:
+            detector.track_vehicles(frame)
+        t2 = time.time()
+        fps.append(len(frames) / max(t2 - t1, 1e-9))
+    windows = sum(stats['mean'] for key, stats in profiler.summary().items() if key.startswith('count/windows/'))
+    # Peak memory and detection quality of a further pass, traced separately so neither tracing
+    # nor matching slows the timed passes
+    detector = VehicleDetector(**dict(classifier, **config))
+    n_detected = n_labeled = n_matched = 0
+    tracemalloc.start()
+    for frame, frame_labels in zip(frames, labels):
+        detector.track_vehicles(frame)
+        if frame_labels is not None:
+            regions = detector.stream(0).regions
+            # Region corners are inclusive
+            detected = np.column_stack((regions[:, REGION_X1], regions[:, REGION_Y1],
+                                        regions[:, REGION_X2] + 1, regions[:, REGION_Y2] + 1))
+            n_detected += len(detected)
+            n_labeled += len(frame_labels)
+            n_matched += count_matches(detected, frame_labels)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = dict(fps=float(np.median(fps)), windows=windows, peak_mb=peak / 2 ** 20)
+    if n_labeled:
+        result['precision'] = n_matched / max(1, n_detected)
+        result['recall'] = n_matched / n_labeled
+        result['f1'] = 2 * n_matched / (n_detected + n_labeled)
+    return result
+
+# Names of the results not beaten on both FPS and F1 by another result
+def pareto_frontier(results):
+    frontier = []
+    for name, result in results.items():
+        dominated = any(other['fps'] >= result['fps'] and other['f1'] >= result['f1'] and
+                        (other['fps'] > result['fps'] or other['f1'] > result['f1'])
+                        for other_name, other in results.items() if other_name != name)
+        if not dominated:
+            frontier.append(name)
+    return frontier
+
+if __name__ == '__main__':
+    frames, labels = recorded_frames(frames_dir) if os.path.isdir(frames_dir) else ([], [])
+    if not frames:
+        print('No frames in', frames_dir + ', using', n_synthetic_frames, 'synthetic frames')
+        frames, _ = synthetic_frames(n_synthetic_frames)
+        labels = [None] * len(frames)
+    classifier, trained = benchmark_classifier(frames[0])
+    if not trained:
+        # Detections of a random model say nothing of detection quality
+        labels = [None] * len(frames)
+    results = {}
+    for name, config in configs:
+        results[name] = run_config(classifier, config, frames, labels)
+        result = results[name]
+        quality = ' precision={:.3f} recall={:.3f} f1={:.3f}'.format(
+            result['precision'], result['recall'], result['f1']) if 'f1' in result else ''
+        print('{:<14} {:6.1f} FPS {:7.1f} windows/frame {:7.1f} MB peak'.format(
+            name, result['fps'], result['windows'], result['peak_mb']) + quality)
+    if all('f1' in result for result in results.values()):
+        print('Pareto frontier (FPS vs F1):', ', '.join(pareto_frontier(results)))
+
+    if '--update-baseline' in sys.argv[1:]:
+        with open(baseline_path, 'w') as f:
+            json.dump({name: result['fps'] for name, result in results.items()}, f, indent=2)
+        print('Baseline written to', baseline_path)
+    else:
+        if not os.path.exists(baseline_path):
+            print('No baseline at', baseline_path + ', run with --update-baseline to write one')
+            sys.exit(1)
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = [name for name, result in results.items()
+                       if name in baseline and result['fps'] < (1 - regression_tolerance) * baseline[name]]
+        for name in regressions:
+            print('Regression: {} at {:.1f} FPS, baseline {:.1f} FPS'.format(name, results[name]['fps'], baseline[name]))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,41 @@
+import numpy as np
+import cv2
+import time
+from classify_vehicles import get_hog_features, get_hog_features_fast, orient, pix_per_cell, cell_per_block
+
+# Search levels used by track_vehicles: (scale, x_start, x_stop, y_start, y_stop)
+search_levels = [(2, 300, 1280, 400, 700), (1.5, 400, 1280, 400, 560), (1, 360, 1280, 400, 528)]
+# Number of timed repetitions per level
+n_repeats = 20
+
+# Time a function over n_repeats calls and return the mean in milliseconds
+def time_ms(func, *args):
+    func(*args)
+    t1 = time.time()
+    for _ in range(n_repeats):
+        func(*args)
+    t2 = time.time()
+    return 1000 * (t2 - t1) / n_repeats
+
+def skimage_hog(img):
+    return [get_hog_features(img[:, :, ch], orient, pix_per_cell, cell_per_block, feature_vec=False)
+            for ch in range(img.shape[2])]
+
+def fast_hog(img):
+    return get_hog_features_fast(img, orient, pix_per_cell, cell_per_block)
+
+if __name__ == '__main__':
+    # Smooth random frame with the size of the project video
+    rng = np.random.RandomState(0)
+    frame = cv2.GaussianBlur((rng.rand(720, 1280, 3) * 255).astype(np.uint8), (7, 7), 2)
+    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2YUV)
+    for scale, x_start, x_stop, y_start, y_stop in search_levels:
+        img_search = frame[y_start:y_stop, x_start:x_stop, :]
+        img_search = cv2.resize(img_search, (np.int(img_search.shape[1] / scale),
+                                             np.int(img_search.shape[0] / scale)))
+        ref = np.array(skimage_hog(img_search))
+        max_diff = np.abs(ref - fast_hog(img_search)).max()
+        t_skimage = time_ms(skimage_hog, img_search)
+        t_fast = time_ms(fast_hog, img_search)
+        print('Scale {} level {}x{}: skimage {:.2f} ms, fast {:.2f} ms, speedup {:.1f}x, max diff {:.2e}'.format(
+            scale, img_search.shape[1], img_search.shape[0], t_skimage, t_fast, t_skimage / t_fast, max_diff))
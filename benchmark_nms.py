@@ -0,0 +1,50 @@
+import numpy as np
+import time
+from nms import non_max_suppression_fast, non_max_suppression_scores
+from nms_slow import non_max_suppression_slow
+
+# Numbers of boxes to benchmark
+box_counts = [100, 300, 1000, 3000, 10000]
+# The Python O(n^2) implementation is only timed up to this many boxes
+slow_max_boxes = 3000
+# Overlap threshold shared by all implementations
+overlap_thresh = 0.3
+# Best of n_repeats calls is reported
+n_repeats = 3
+
+# Random sliding windows of the three search scales inside the search band
+def random_windows(n, rng):
+    sizes = rng.choice([64, 96, 128], n)
+    x1 = rng.randint(300, 1280 - 128, n)
+    y1 = rng.randint(400, 700 - 128, n)
+    boxes = np.stack((x1, y1, x1 + sizes, y1 + sizes), axis=1)
+    return boxes, rng.randn(n) + 1, sizes
+
+# Return the result and best run time in milliseconds over n_repeats calls
+def time_ms(func, *args, **kwargs):
+    best = None
+    for _ in range(n_repeats):
+        t1 = time.time()
+        result = func(*args, **kwargs)
+        t2 = time.time()
+        best = t2 - t1 if best is None else min(best, t2 - t1)
+    return result, 1000 * best
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    print('Overlap metrics differ: slow and fast use intersection over the suppressed box area,')
+    print('scores uses IoU, so the kept counts are given for reference only')
+    print('{:>6} {:>10} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'boxes', 'slow ms', 'fast ms', 'scores ms', 'per-scale ms', 'fast kept', 'scores kept'))
+    for n in box_counts:
+        boxes, scores, sizes = random_windows(n, rng)
+        if n <= slow_max_boxes:
+            _, t_slow = time_ms(non_max_suppression_slow, boxes, overlap_thresh)
+            t_slow = '{:.2f}'.format(t_slow)
+        else:
+            t_slow = '-'
+        fast_kept, t_fast = time_ms(non_max_suppression_fast, boxes, overlap_thresh)
+        scores_kept, t_scores = time_ms(non_max_suppression_scores, boxes, scores, overlap_thresh)
+        _, t_groups = time_ms(non_max_suppression_scores, boxes, scores, overlap_thresh, groups=sizes)
+        print('{:>6} {:>10} {:>10.2f} {:>10.2f} {:>12.2f} {:>12} {:>12}'.format(
+            n, t_slow, t_fast, t_scores, t_groups, len(fast_kept), len(scores_kept)))
@@ -0,0 +1,66 @@
+import sys
+import glob
+import numpy as np
+import cv2
+from detect_vehicles import VehicleDetector, FeaturePyramid
+from classify_vehicles import svm_model_path, scaler_model_path, svc_conf_thresh, \
+    pix_per_cell, cell_per_block, train_img_width
+
+# Recorded frames checked, synthetic road frames if there are none
+frame_files = 'test_images/*.jpg'
+n_frames = 4
+# Search levels used by track_vehicles: (scale, x_start, x_stop, y_start, y_stop, cells_per_xstep, cells_per_ystep)
+search_levels = [(2, 300, 1280, 400, 700, 2, 2), (1.5, 400, 1280, 400, 560, 2, 2), (1, 360, 1280, 400, 528, 4, 4)]
+
+# Accepted windows of one level with the original per-window path: scale each window's features
+# with X_scaler, then svc.predict and svc.decision_function, on the same HOG blocks
+def per_window_boxes(hogs, svc, X_scaler, scale, cells_per_xstep, cells_per_ystep, x_start, y_start):
+    nyblocks, nxblocks = hogs.shape[1:3]
+    window = train_img_width
+    nwinblocks = (window // pix_per_cell) - cell_per_block + 1
+    nxsteps = (nxblocks - nwinblocks) // cells_per_xstep
+    nysteps = (nyblocks - nwinblocks) // cells_per_ystep
+    boxes = []
+    for xb in range(nxsteps):
+        for yb in range(nysteps):
+            ypos = yb * cells_per_ystep
+            xpos = xb * cells_per_xstep
+            feature_vector = np.hstack([hogs[ch, ypos:ypos + nwinblocks, xpos:xpos + nwinblocks].ravel()
+                                        for ch in range(hogs.shape[0])]).astype(np.float64)
+            test_features = X_scaler.transform(feature_vector.reshape(1, -1))
+            if svc.predict(test_features) == 1 and svc.decision_function(test_features) > svc_conf_thresh:
+                win_scaled = np.int(window * scale)
+                startx = np.int(xpos * pix_per_cell * scale) + x_start
+                starty = np.int(ypos * pix_per_cell * scale) + y_start
+                boxes.append(((startx, starty), (startx + win_scaled, starty + win_scaled)))
+    return boxes
+
+if __name__ == '__main__':
+    files = sorted(glob.glob(frame_files))[:n_frames]
+    if files:
+        frames = [cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB) for file in files]
+    else:
+        from benchmark_detection import synthetic_frames
+        print('No frames matching', frame_files + ', using synthetic frames')
+        frames, _ = synthetic_frames(n_frames)
+    from sklearn.externals import joblib
+    svc = joblib.load(svm_model_path)
+    X_scaler = joblib.load(scaler_model_path)
+    detector = VehicleDetector(svc, X_scaler, svc_conf_thresh=svc_conf_thresh)
+    n_accepted = 0
+    n_mismatched = 0
+    for i, frame in enumerate(frames):
+        for scale, x_start, x_stop, y_start, y_stop, cells_per_xstep, cells_per_ystep in search_levels:
+            pyramid = FeaturePyramid(frame, [(scale, x_start, x_stop, y_start, y_stop)])
+            batched = detector.find_vehicles(frame, scale, cells_per_xstep, cells_per_ystep,
+                                             x_start, x_stop, y_start, y_stop, pyramid=pyramid)
+            expected = per_window_boxes(pyramid.level(scale), svc, X_scaler, scale,
+                                        cells_per_xstep, cells_per_ystep, x_start, y_start)
+            mismatched = set(batched) ^ set(expected)
+            n_accepted += len(expected)
+            n_mismatched += len(mismatched)
+            print('Frame {} scale {}: {} windows per-window, {} batched, {} mismatched'.format(
+                i, scale, len(expected), len(batched), len(mismatched)))
+    print('{} accepted windows, {} mismatched'.format(n_accepted, n_mismatched))
+    if n_mismatched:
+        sys.exit(1)
@@ -1,16 +1,19 @@
+import os
 import numpy as np
 import cv2
 import glob
 import time
-from skimage.feature import hog
-from sklearn.svm import LinearSVC
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split, GridSearchCV
-from sklearn.externals import joblib
+import hashlib
+from functools import partial
+from multiprocessing import Pool
+from packed_dataset import PackedDataset, packed_images
+
+# skimage and sklearn are only imported by training code, so detection starts without them
 
 # Define a function to return HOG features and visualization
 def get_hog_features(img, orient, pix_per_cell, cell_per_block,
                      vis=False, feature_vec=True):
+    from skimage.feature import hog
     # Call with two outputs if vis==True
     if vis == True:
         features, hog_image = hog(img, orientations=orient,
@@ -29,6 +32,88 @@ def get_hog_features(img, orient, pix_per_cell, cell_per_block,
         return features
 
 
+# Pixel to cell index maps for get_hog_features_fast, cached by image size
+hog_cell_index_cache = {}
+# Square root lookup table for 8-bit images
+hog_sqrt_lut = np.sqrt(np.arange(256, dtype=np.float64))
+
+# Define a function to return HOG features of all channels in one vectorised pass.
+# Reproduces get_hog_features(..., feature_vec=False) for transform_sqrt=True and returns
+# an array of shape (channels, n_blocks_y, n_blocks_x, cell_per_block, cell_per_block, orient)
+def get_hog_features_fast(img, orient, pix_per_cell, cell_per_block, block_norm='L1'):
+    if img.ndim == 2:
+        img = img[:, :, np.newaxis]
+    n_rows, n_cols, n_channels = img.shape
+    n_cells_y = n_rows // pix_per_cell
+    n_cells_x = n_cols // pix_per_cell
+    n_blocks_y = n_cells_y - cell_per_block + 1
+    n_blocks_x = n_cells_x - cell_per_block + 1
+    if n_blocks_y <= 0 or n_blocks_x <= 0:
+        return np.zeros((n_channels, max(n_blocks_y, 0), max(n_blocks_x, 0),
+                         cell_per_block, cell_per_block, orient))
+    # Power law compression and centred [-1, 0, 1] gradients with zero borders
+    if img.dtype == np.uint8:
+        img_sqrt = cv2.LUT(img, hog_sqrt_lut)
+    else:
+        img_sqrt = np.sqrt(img.astype(np.float64))
+    gx = cv2.Sobel(img_sqrt, cv2.CV_64F, 1, 0, ksize=1, borderType=cv2.BORDER_CONSTANT)
+    gy = cv2.Sobel(img_sqrt, cv2.CV_64F, 0, 1, ksize=1, borderType=cv2.BORDER_CONSTANT)
+    gx = gx.reshape(n_rows, n_cols, n_channels)
+    gy = gy.reshape(n_rows, n_cols, n_channels)
+    gx[:, 0] = 0
+    gx[:, -1] = 0
+    gy[0, :] = 0
+    gy[-1, :] = 0
+    # Only pixels inside whole cells contribute to the histograms
+    gx = gx[:n_cells_y * pix_per_cell, :n_cells_x * pix_per_cell]
+    gy = gy[:n_cells_y * pix_per_cell, :n_cells_x * pix_per_cell]
+    gx = gx.ravel()
+    gy = gy.ravel()
+    magnitude = cv2.magnitude(gx, gy).ravel()
+    # Orientation over [0, 360) degrees binned into 2 * orient bins, using the fast single precision
+    # cv2.phase (accurate to about 0.01 degrees) for the bulk of the pixels
+    orient_pos = cv2.phase(gx.astype(np.float32), gy.astype(np.float32)).ravel()
+    orient_pos *= orient / np.pi
+    orient_bin = orient_pos.astype(np.intp)
+    orient_frac = orient_pos - orient_bin
+    np.minimum(orient_bin, 2 * orient - 1, out=orient_bin)
+    # Re-bin pixels lying within 0.05 degrees of a bin edge in double precision, as skimage does
+    edge_tol = 0.05 * orient / 180.
+    near_edge = np.flatnonzero(((orient_frac < edge_tol) | (orient_frac > 1 - edge_tol)) & (gy != 0))
+    orient_bin[near_edge] = (np.rad2deg(np.arctan2(gy[near_edge], gx[near_edge])) % 180) * (orient / 180.)
+    # Histogram index of every pixel: ((cell_y * n_cells_x + cell_x) * n_channels + channel) * 2 * orient
+    key = (n_cells_y, n_cells_x, n_channels, pix_per_cell, orient)
+    if key not in hog_cell_index_cache:
+        cell_y = np.arange(n_cells_y * pix_per_cell) // pix_per_cell
+        cell_x = np.arange(n_cells_x * pix_per_cell) // pix_per_cell
+        cell_index = (cell_y[:, None, None] * n_cells_x + cell_x[None, :, None]) * n_channels \
+                     + np.arange(n_channels)[None, None, :]
+        hog_cell_index_cache[key] = (cell_index * 2 * orient).ravel()
+    hist_index = hog_cell_index_cache[key] + orient_bin
+    # Mean gradient magnitude per cell and orientation bin, folding opposite directions together
+    hist = np.bincount(hist_index, weights=magnitude, minlength=n_cells_y * n_cells_x * n_channels * 2 * orient)
+    hist = hist.reshape(n_cells_y, n_cells_x, n_channels, 2, orient).sum(axis=3) / (pix_per_cell * pix_per_cell)
+    hist = hist.transpose(2, 0, 1, 3)
+    # Group cells into overlapping blocks
+    blocks = np.empty((n_channels, n_blocks_y, n_blocks_x, cell_per_block, cell_per_block, orient))
+    for by in range(cell_per_block):
+        for bx in range(cell_per_block):
+            blocks[:, :, :, by, bx] = hist[:, by:by + n_blocks_y, bx:bx + n_blocks_x]
+    # Normalise each block
+    eps = 1e-5
+    if block_norm == 'L1':
+        blocks /= blocks.sum(axis=(3, 4, 5), keepdims=True) + eps
+    elif block_norm == 'L2':
+        blocks /= np.sqrt((blocks ** 2).sum(axis=(3, 4, 5), keepdims=True) + eps ** 2)
+    elif block_norm == 'L2-Hys':
+        blocks /= np.sqrt((blocks ** 2).sum(axis=(3, 4, 5), keepdims=True) + eps ** 2)
+        np.minimum(blocks, 0.2, out=blocks)
+        blocks /= np.sqrt((blocks ** 2).sum(axis=(3, 4, 5), keepdims=True) + eps ** 2)
+    else:
+        raise ValueError('Selected block normalization method is invalid.')
+    return blocks
+
+
 # Define a function to compute binned color features
 def bin_spatial(img, size=(32, 32)):
     # Use cv2.resize().ravel() to create the feature vector
@@ -49,62 +134,288 @@ def color_hist(img, nbins=32, bins_range=(0, 256)):
     return hist_features
 
 
-# Define a function to extract features from a list of images
+# On-disk store of image feature vectors for one feature parameter set, keyed by image path
+# and modification time so only new or changed images are featurized again
+class FeatureStore(object):
+    def __init__(self, store_dir, params):
+        # One store file per feature parameter set
+        key = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:16]
+        self.path = os.path.join(store_dir, 'features_' + key + '.npz')
+        self.entries = {}
+        self.modified = False
+        if os.path.exists(self.path):
+            with np.load(self.path) as store:
+                for path, mtime, features in zip(store['paths'], store['mtimes'], store['features']):
+                    self.entries[str(path)] = (mtime, features)
+
+    def lookup(self, file, mtime):
+        entry = self.entries.get(os.path.abspath(file))
+        if entry is None or entry[0] != mtime:
+            return None
+        return entry[1]
+
+    def add(self, file, mtime, features):
+        self.entries[os.path.abspath(file)] = (mtime, features)
+        self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        paths = sorted(self.entries)
+        # Write to a temporary file first so an interrupted save keeps the old store
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, paths=np.array(paths),
+                     mtimes=np.array([self.entries[path][0] for path in paths]),
+                     features=np.array([self.entries[path][1] for path in paths]))
+        os.replace(tmp_path, self.path)
+        self.modified = False
+
+# Define a function to convert a BGR image to color_space
+def convert_color(img, color_space='RGB'):
+    # apply color conversion if other than 'RGB'
+    if color_space == 'RGB':
+        feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    elif color_space == 'Lab':
+        feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2Lab)
+    elif color_space == 'YUV':
+        feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)
+    elif color_space == 'YCrCb':
+        feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
+    elif color_space == 'HSV':
+        feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    elif color_space == 'LUV':
+        feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2LUV)
+    elif color_space == 'HLS':
+        feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2HLS)
+    else:
+        feature_image = np.copy(img)
+    return feature_image
+
+# Define a function to extract the feature vector of one BGR image
+def image_features(img, color_space='RGB', spatial_size=(32, 32),
+                   hist_bins=32, orient=9,
+                   pix_per_cell=8, cell_per_block=2, hog_channel=0,
+                   use_spatial=True, use_hist=True, use_hog=True):
+    file_features = []
+    feature_image = convert_color(img, color_space)
+
+    if use_spatial == True:
+        spatial_features = bin_spatial(feature_image, size=spatial_size)
+        file_features.append(spatial_features)
+    if use_hist == True:
+        # Apply color_hist()
+        hist_features = color_hist(feature_image, nbins=hist_bins)
+        file_features.append(hist_features)
+    if use_hog == True:
+        # Call get_hog_features() with vis=False, feature_vec=True
+        if hog_channel == 'ALL':
+            hog_features = []
+            for channel in range(feature_image.shape[2]):
+                hog_features.append(get_hog_features(feature_image[:, :, channel],
+                                                     orient, pix_per_cell, cell_per_block,
+                                                     vis=False, feature_vec=True))
+            hog_features = np.ravel(hog_features)
+        else:
+            hog_features = get_hog_features(feature_image[:, :, hog_channel], orient,
+                                            pix_per_cell, cell_per_block, vis=False, feature_vec=True)
+        # Append the new feature vector to the features list
+        file_features.append(hog_features)
+    return np.concatenate(file_features)
+
+# Features of crops start to stop of a packed dataset of n_crops crops, for extraction worker
+# processes. The data file is mapped directly, without reading the dataset index.
+def extract_packed_features(packed_range, dataset_path=None, n_crops=0, **params):
+    start, stop = packed_range
+    return [image_features(img, **params) for img in packed_images(dataset_path, n_crops)[start:stop]]
+
+# Define a function to extract features from a list of images files or a PackedDataset,
+# optionally across a process pool of n_jobs workers (-1 for all cores) in chunks of chunk_size
+# images, and reusing features cached in store_dir for unchanged image files. Packed crops are
+# read from the memory-mapped file and not cached in the feature store, since they need no decoding.
 def extract_features(imgs, color_space='RGB', spatial_size=(32, 32),
                      hist_bins=32, orient=9,
                      pix_per_cell=8, cell_per_block=2, hog_channel=0,
-                     use_spatial=True, use_hist=True, use_hog=True):
+                     use_spatial=True, use_hist=True, use_hog=True,
+                     n_jobs=1, chunk_size=256, store_dir=None):
+    params = dict(color_space=color_space, spatial_size=tuple(spatial_size), hist_bins=hist_bins,
+                  orient=orient, pix_per_cell=pix_per_cell, cell_per_block=cell_per_block,
+                  hog_channel=hog_channel, use_spatial=use_spatial, use_hist=use_hist, use_hog=use_hog)
+    if isinstance(imgs, PackedDataset):
+        ranges = imgs.chunk_ranges(chunk_size)
+        extract = partial(extract_packed_features, dataset_path=imgs.path, n_crops=len(imgs), **params)
+        if n_jobs != 1 and len(ranges) > 1:
+            with Pool(n_jobs if n_jobs > 0 else None) as pool:
+                chunk_features = pool.map(extract, ranges)
+        else:
+            chunk_features = [extract(packed_range) for packed_range in ranges]
+        return [img_features for chunk in chunk_features for img_features in chunk]
+    if store_dir is not None:
+        store = FeatureStore(store_dir, params)
+        mtimes = [os.path.getmtime(file) for file in imgs]
+        features = [store.lookup(file, mtime) for file, mtime in zip(imgs, mtimes)]
+        # Featurize only images missing from the store or modified since they were stored
+        missing = [i for i, file_features in enumerate(features) if file_features is None]
+        print('Feature store:', len(imgs) - len(missing), 'cached,', len(missing), 'to extract')
+        new_features = extract_features([imgs[i] for i in missing], n_jobs=n_jobs,
+                                        chunk_size=chunk_size, **params)
+        for i, file_features in zip(missing, new_features):
+            features[i] = file_features
+            store.add(imgs[i], mtimes[i], file_features)
+        store.save()
+        return features
+    if n_jobs != 1 and len(imgs) > chunk_size:
+        chunks = [imgs[i:i + chunk_size] for i in range(0, len(imgs), chunk_size)]
+        with Pool(n_jobs if n_jobs > 0 else None) as pool:
+            chunk_features = pool.map(partial(extract_features, **params), chunks)
+        return [file_features for chunk in chunk_features for file_features in chunk]
     # Create a list to append feature vectors to
     features = []
     # Iterate through the list of images
     for file in imgs:
-        file_features = []
         # Read in each one by one
         img = cv2.imread(file)
-
-        # apply color conversion if other than 'RGB'
-        if color_space == 'RGB':
-            feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        elif color_space == 'Lab':
-            feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2Lab)
-        elif color_space == 'YUV':
-            feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2YUV)
-        elif color_space == 'YCrCb':
-            feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
-        elif color_space == 'HSV':
-            feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        elif color_space == 'LUV':
-            feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2LUV)
-        elif color_space == 'HLS':
-            feature_image = cv2.cvtColor(img, cv2.COLOR_BGR2HLS)
-        else:
-            feature_image = np.copy(img)
-
-        if use_spatial == True:
-            spatial_features = bin_spatial(feature_image, size=spatial_size)
-            file_features.append(spatial_features)
-        if use_hist == True:
-            # Apply color_hist()
-            hist_features = color_hist(feature_image, nbins=hist_bins)
-            file_features.append(hist_features)
-        if use_hog == True:
-            # Call get_hog_features() with vis=False, feature_vec=True
-            if hog_channel == 'ALL':
-                hog_features = []
-                for channel in range(feature_image.shape[2]):
-                    hog_features.append(get_hog_features(feature_image[:, :, channel],
-                                                         orient, pix_per_cell, cell_per_block,
-                                                         vis=False, feature_vec=True))
-                hog_features = np.ravel(hog_features)
-            else:
-                hog_features = get_hog_features(feature_image[:, :, hog_channel], orient,
-                                                pix_per_cell, cell_per_block, vis=False, feature_vec=True)
-            # Append the new feature vector to the features list
-            file_features.append(hog_features)
-        features.append(np.concatenate(file_features))
+        features.append(image_features(img, **params))
     # Return list of feature vectors
     return features
 
+# Train the first stage of a cascade on the first n_features columns of scaled training features.
+# The stage is a linear SVM whose decision threshold is set on held-out windows so that a fraction
+# recall of the vehicles pass, letting the full classifier reject the rest of the survivors.
+def train_cascade_stage(X_train, y_train, n_features, recall=0.99, C=0.01, validation_size=0.2):
+    from sklearn.svm import LinearSVC
+    from sklearn.model_selection import train_test_split
+    X_fit, X_val, y_fit, y_val = train_test_split(X_train[:, :n_features], y_train,
+                                                  test_size=validation_size, random_state=0)
+    stage_svc = LinearSVC(C=C)
+    stage_svc.fit(X_fit, y_fit)
+    # Lowest decision value keeping the target fraction of validation vehicles
+    car_scores = stage_svc.decision_function(X_val[y_val == 1])
+    threshold = np.percentile(car_scores, 100 * (1 - recall))
+    return {'svc': stage_svc, 'n_features': n_features, 'threshold': threshold}
+
+# Fraction of vehicles and of non-vehicles passing a cascade stage on scaled features
+def cascade_pass_rates(stage, X, y):
+    passed = stage['svc'].decision_function(X[:, :stage['n_features']]) >= stage['threshold']
+    return passed[y == 1].mean(), passed[y == 0].mean()
+
+# Train a linear SVM out of core on a PackedDataset. A first pass extracts the features of
+# chunk_size crops at a time into a float32 file at features_path and fits the scaler
+# incrementally on the training crops. Each epoch then reads the training features in shuffled
+# chunks and updates an SGD classifier with hinge loss, so peak memory is bounded by the chunk
+# size. A test_size fraction of the crops is held out and streamed for the test accuracy.
+# Returns the classifier, the scaler and the test accuracy, usable like LinearSVC and its scaler.
+def train_streaming(dataset, chunk_size=1024, n_jobs=1, epochs=5, alpha=1e-4, test_size=0.2,
+                    features_path='./stream_features.f32', random_state=0, **params):
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.preprocessing import StandardScaler
+    rng = np.random.RandomState(random_state)
+    n_crops = len(dataset)
+    held_out = rng.rand(n_crops) < test_size
+    labels = dataset.labels.astype(np.float64)
+    ranges = dataset.chunk_ranges(chunk_size)
+
+    # Extract features chunk by chunk to disk and fit the scaler on the training crops
+    X_scaler = StandardScaler()
+    extract = partial(extract_packed_features, dataset_path=dataset.path, n_crops=n_crops, **params)
+    pool = Pool(n_jobs if n_jobs > 0 else None) if n_jobs != 1 and len(ranges) > 1 else None
+    try:
+        chunk_features = pool.imap(extract, ranges) if pool is not None else map(extract, ranges)
+        features = None
+        for (start, stop), chunk in zip(ranges, chunk_features):
+            chunk = np.array(chunk, dtype=np.float32)
+            if features is None:
+                os.makedirs(os.path.dirname(os.path.abspath(features_path)), exist_ok=True)
+                features = np.memmap(features_path, dtype=np.float32, mode='w+', shape=(n_crops, chunk.shape[1]))
+            features[start:stop] = chunk
+            if not held_out[start:stop].all():
+                X_scaler.partial_fit(chunk[~held_out[start:stop]])
+        features.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    # Epochs over the training crops in a new random order each time
+    svc = SGDClassifier(loss='hinge', alpha=alpha, random_state=random_state)
+    train_index = np.flatnonzero(~held_out)
+    for epoch in range(epochs):
+        order = rng.permutation(train_index)
+        for start in range(0, len(order), chunk_size):
+            # Sorted reads keep the access to the feature file sequential within a chunk
+            index = np.sort(order[start:start + chunk_size])
+            svc.partial_fit(X_scaler.transform(features[index]), labels[index], classes=np.array([0., 1.]))
+
+    # Accuracy on the held out crops
+    test_index = np.flatnonzero(held_out)
+    n_correct = 0
+    for start in range(0, len(test_index), chunk_size):
+        index = test_index[start:start + chunk_size]
+        n_correct += (svc.predict(X_scaler.transform(features[index])) == labels[index]).sum()
+    del features
+    return svc, X_scaler, n_correct / max(1, len(test_index))
+
+# Fold the per-column scaler into the linear SVM so a window is scored with one dot product.
+# A model trained on the first n_features scaled columns only uses those columns of the scaler.
+def fold_scaler(svc, X_scaler, n_features=None):
+    # ((x - mean) / scale) . w + b  ==  x . (w / scale) + (b - mean . (w / scale))
+    weights = svc.coef_.ravel().astype(np.float64)
+    bias = np.float64(svc.intercept_[0])
+    if X_scaler.with_std:
+        weights = weights / X_scaler.scale_[:n_features]
+    if X_scaler.with_mean:
+        bias = bias - np.dot(X_scaler.mean_[:n_features], weights)
+    return weights, bias
+
+# Version of the compact model file written by save_model
+MODEL_FORMAT_VERSION = 1
+
+# Feature parameters of the current configuration, stored in the compact model file
+def feature_params():
+    return dict(color_space=color_space, orient=orient, pix_per_cell=pix_per_cell,
+                cell_per_block=cell_per_block, hog_channel=str(hog_channel), spatial_size=spatial_size,
+                hist_bins=hist_bins, use_spatial=use_spatial, use_hist=use_hist, use_hog=use_hog,
+                train_img_width=train_img_width, train_img_height=train_img_height)
+
+# Save a trained classifier as a compact .npz holding the weights with the scaler folded in, the
+# bias, the decision threshold, the feature parameters and the optional first cascade stage.
+# Loading it needs numpy only.
+def save_model(path, svc, X_scaler, threshold, cascade=None):
+    weights, bias = fold_scaler(svc, X_scaler)
+    arrays = dict(format_version=MODEL_FORMAT_VERSION, weights=weights, bias=bias, threshold=threshold)
+    for name, value in feature_params().items():
+        arrays['param_' + name] = value
+    if cascade is not None:
+        arrays['cascade_weights'], arrays['cascade_bias'] = fold_scaler(
+            cascade['svc'], X_scaler, n_features=cascade['n_features'])
+        arrays['cascade_threshold'] = cascade['threshold']
+    np.savez(path, **arrays)
+
+# Load a compact model file as a dict of weights, bias, threshold, params and, for a cascade,
+# cascade_weights, cascade_bias and cascade_threshold unless cascade is False
+def load_model(path, cascade=True):
+    with np.load(path, allow_pickle=False) as data:
+        version = int(data['format_version'])
+        if version != MODEL_FORMAT_VERSION:
+            raise ValueError('Unsupported model format version {} in {}'.format(version, path))
+        model = {'params': {}}
+        for name in data.files:
+            if name.startswith('param_'):
+                value = data[name]
+                model['params'][name[len('param_'):]] = tuple(value.tolist()) if value.ndim else value.item()
+            elif name != 'format_version' and (cascade or not name.startswith('cascade_')):
+                value = data[name]
+                model[name] = value if value.ndim else value.item()
+    return model
+
+# Raise ValueError if a model was trained with features other than the current configuration
+def check_model_params(model):
+    params = feature_params()
+    mismatched = [name for name, value in model['params'].items() if params.get(name) != value]
+    if mismatched:
+        raise ValueError('Model feature parameters differ from the configuration: ' + ', '.join(
+            '{}={} (configured {})'.format(name, model['params'][name], params.get(name)) for name in mismatched))
+
 train_img_width  = 64       # Width of images in training dataset
 train_img_height = 64       # Height of images in training dataset
 color_space      = 'YUV'    # Can be RGB, HSV, LUV, HLS, YUV, YCrCb
@@ -117,75 +428,154 @@ hist_bins        = 16       # Number of histogram bins
 use_spatial      = False    # Spatial features on or off
 use_hist         = False    # Histogram features on or off
 use_hog          = True     # HOG features on or off
+n_jobs           = -1       # Feature extraction worker processes, -1 for all cores
+chunk_size       = 256      # Images per feature extraction task
+feature_store_dir= './feature_store'        # Cached training features
+packed_dataset_path = './dataset/packed.u8'  # Training crops packed by packed_dataset.py, used if present
 vehicles_dir     = './dataset/vehicles'     # Vehicle training images directory
 non_vehicles_dir = './dataset/non-vehicles' # Non-vehicle training images directory
 svm_model_path   = './svm_model.pkl'        # Trained classifier saved model
+svc_conf_thresh  = 1.0      # Classifier confidence above which detection is true
+use_cascade      = False    # Train and detect with a cheap first stage rejecting most non-vehicle windows
+cascade_channels = 1        # HOG channels used by the first stage, from the first
+cascade_recall   = 0.995    # Fraction of vehicles the first stage must pass
+cascade_model_path = './cascade_model.pkl' # First stage of the cascade classifier
+model_path       = './vehicle_model.npz'    # Compact model used for detection
+streaming_training = False  # Train out of core on the packed dataset with an SGD classifier
+sgd_epochs       = 5        # Passes over the training features when streaming
+sgd_alpha        = 1e-4     # SGD regularisation strength
+stream_features_path = './feature_store/stream_features.f32' # Features of the packed dataset on disk
 scaler_model_path= './scaler_model.pkl'     # Trained scaler model for classifier
 
 if __name__ == '__main__':
-    # Create empty list to store car image names
-    img_names = []
-    # Read in vehicles and non-vehicles
-    cars = []
-    for img_type in ['*.png', '*.jpg']:
-        img_names.extend(glob.glob(vehicles_dir + '/**/' + img_type, recursive=True))
-    for img_name in img_names:
-        cars.append(img_name)
-    # Delete list to append non-car images now
-    del img_names[:]
-    img_names = []
-    notcars = []
-    for img_type in ['*.png', '*.jpg']:
-        img_names.extend(glob.glob(non_vehicles_dir + '/**/' + img_type, recursive=True))
-    for img_name in img_names:
-        notcars.append(img_name)
-    print('Cars set size: ', len(cars), ' Non-cars set size: ', len(notcars))
-
-    car_features = extract_features(cars, color_space=color_space,
-                                    spatial_size=spatial_size, hist_bins=hist_bins,
-                                    orient=orient, pix_per_cell=pix_per_cell,
-                                    cell_per_block=cell_per_block,
-                                    hog_channel=hog_channel, use_spatial=use_spatial,
-                                    use_hist=use_hist, use_hog=use_hog)
-    notcar_features = extract_features(notcars, color_space=color_space,
-                                       spatial_size=spatial_size, hist_bins=hist_bins,
-                                       orient=orient, pix_per_cell=pix_per_cell,
-                                       cell_per_block=cell_per_block,
-                                       hog_channel=hog_channel, use_spatial=use_spatial,
-                                       use_hist=use_hist, use_hog=use_hog)
-    X = np.vstack((car_features, notcar_features)).astype(np.float64)
-    # Fit a per-column scaler
-    X_scaler = StandardScaler().fit(X)
-    # Apply the scaler to X
-    scaled_X = X_scaler.transform(X)
-    # Define the labels vector
-    y = np.hstack((np.ones(len(car_features)), np.zeros(len(notcar_features))))
-
-    # Split up data into randomized training and test sets
-    rand_state = np.random.randint(0, 100)
-    X_train, X_test, y_train, y_test = train_test_split(
-        scaled_X, y, test_size=0.2, random_state=rand_state)
-
-    print('Using:', orient, 'orientations', pix_per_cell,
-          'pixels per cell and', cell_per_block, 'cells per block')
-    print('Feature vector length:', len(X_train[0]))
-
-    # Use a linear SVC
-    svc = LinearSVC(C=0.01)
-    # Check the training time for the SVC
-    t = time.time()
-    #parameters = {'kernel': ('linear', 'rbf'), 'C': range(1, 11)}
-    #parameters = {'C': np.linspace(0.01,2, num = 20)}
-    #svc = GridSearchCV(svc, parameters)
-    svc.fit(X_train, y_train)
-    t2 = time.time()
-    print(round(t2 - t, 2), 'Seconds to train SVC...')
-    #print('Best C: ', svc.best_params_)
-    # Check the score of the SVC
-    print('Test Accuracy of SVC = ', round(svc.score(X_test, y_test), 4))
+    from sklearn.svm import LinearSVC
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.model_selection import train_test_split, GridSearchCV
+    from sklearn.externals import joblib
+    if streaming_training == True:
+        # Features are streamed from the packed dataset, so memory is bounded by the chunk size
+        dataset = PackedDataset(packed_dataset_path)
+        if len(dataset) == 0:
+            raise IOError('No packed dataset at ' + packed_dataset_path + ', run packed_dataset.py first')
+        print('Packed set size: ', len(dataset), ' cars: ', int(dataset.labels.sum()))
+        t = time.time()
+        svc, X_scaler, test_accuracy = train_streaming(
+            dataset, chunk_size=chunk_size, n_jobs=n_jobs, epochs=sgd_epochs, alpha=sgd_alpha,
+            features_path=stream_features_path, color_space=color_space,
+            spatial_size=spatial_size, hist_bins=hist_bins,
+            orient=orient, pix_per_cell=pix_per_cell,
+            cell_per_block=cell_per_block,
+            hog_channel=hog_channel, use_spatial=use_spatial,
+            use_hist=use_hist, use_hog=use_hog)
+        print(round(time.time() - t, 2), 'Seconds to extract features and train SGD classifier...')
+        print('Test Accuracy of SGD classifier = ', round(test_accuracy, 4))
+        # The cascade stage is trained on in-memory features only
+        stage = None
+    else:
+        if os.path.exists(packed_dataset_path + '.index.npz'):
+            # Crops packed by packed_dataset.py, read without decoding
+            dataset = PackedDataset(packed_dataset_path)
+            print('Packed set size: ', len(dataset), ' cars: ', int(dataset.labels.sum()))
+            X = np.vstack(extract_features(dataset, color_space=color_space,
+                                           spatial_size=spatial_size, hist_bins=hist_bins,
+                                           orient=orient, pix_per_cell=pix_per_cell,
+                                           cell_per_block=cell_per_block,
+                                           hog_channel=hog_channel, use_spatial=use_spatial,
+                                           use_hist=use_hist, use_hog=use_hog,
+                                           n_jobs=n_jobs, chunk_size=chunk_size)).astype(np.float64)
+            # Define the labels vector
+            y = dataset.labels.astype(np.float64)
+        else:
+            # Create empty list to store car image names
+            img_names = []
+            # Read in vehicles and non-vehicles
+            cars = []
+            for img_type in ['*.png', '*.jpg']:
+                img_names.extend(glob.glob(vehicles_dir + '/**/' + img_type, recursive=True))
+            for img_name in img_names:
+                cars.append(img_name)
+            # Delete list to append non-car images now
+            del img_names[:]
+            img_names = []
+            notcars = []
+            for img_type in ['*.png', '*.jpg']:
+                img_names.extend(glob.glob(non_vehicles_dir + '/**/' + img_type, recursive=True))
+            for img_name in img_names:
+                notcars.append(img_name)
+            print('Cars set size: ', len(cars), ' Non-cars set size: ', len(notcars))
+
+            car_features = extract_features(cars, color_space=color_space,
+                                            spatial_size=spatial_size, hist_bins=hist_bins,
+                                            orient=orient, pix_per_cell=pix_per_cell,
+                                            cell_per_block=cell_per_block,
+                                            hog_channel=hog_channel, use_spatial=use_spatial,
+                                            use_hist=use_hist, use_hog=use_hog,
+                                            n_jobs=n_jobs, chunk_size=chunk_size, store_dir=feature_store_dir)
+            notcar_features = extract_features(notcars, color_space=color_space,
+                                               spatial_size=spatial_size, hist_bins=hist_bins,
+                                               orient=orient, pix_per_cell=pix_per_cell,
+                                               cell_per_block=cell_per_block,
+                                               hog_channel=hog_channel, use_spatial=use_spatial,
+                                               use_hist=use_hist, use_hog=use_hog,
+                                               n_jobs=n_jobs, chunk_size=chunk_size, store_dir=feature_store_dir)
+            X = np.vstack((car_features, notcar_features)).astype(np.float64)
+            # Define the labels vector
+            y = np.hstack((np.ones(len(car_features)), np.zeros(len(notcar_features))))
+        # Fit a per-column scaler
+        X_scaler = StandardScaler().fit(X)
+        # Apply the scaler to X
+        scaled_X = X_scaler.transform(X)
+
+        # Split up data into randomized training and test sets
+        rand_state = np.random.randint(0, 100)
+        X_train, X_test, y_train, y_test = train_test_split(
+            scaled_X, y, test_size=0.2, random_state=rand_state)
+
+        print('Using:', orient, 'orientations', pix_per_cell,
+              'pixels per cell and', cell_per_block, 'cells per block')
+        print('Feature vector length:', len(X_train[0]))
+
+        # Use a linear SVC
+        svc = LinearSVC(C=0.01)
+        # Check the training time for the SVC
+        t = time.time()
+        #parameters = {'kernel': ('linear', 'rbf'), 'C': range(1, 11)}
+        #parameters = {'C': np.linspace(0.01,2, num = 20)}
+        #svc = GridSearchCV(svc, parameters)
+        svc.fit(X_train, y_train)
+        t2 = time.time()
+        print(round(t2 - t, 2), 'Seconds to train SVC...')
+        #print('Best C: ', svc.best_params_)
+        # Check the score of the SVC
+        print('Test Accuracy of SVC = ', round(svc.score(X_test, y_test), 4))
+
+        if use_cascade == True:
+            # The first stage sees the HOG features of the first cascade_channels channels only,
+            # which lead the feature vector when HOG is the only feature
+            assert use_hog and hog_channel == 'ALL' and not use_spatial and not use_hist
+            n_stage_features = len(X_train[0]) // 3 * cascade_channels
+            t = time.time()
+            stage = train_cascade_stage(X_train, y_train, n_stage_features, recall=cascade_recall)
+            print(round(time.time() - t, 2), 'Seconds to train cascade stage on', n_stage_features, 'features')
+            car_rate, notcar_rate = cascade_pass_rates(stage, X_test, y_test)
+            print('Cascade stage passes {:.4f} of test vehicles and {:.4f} of test non-vehicles'.format(
+                car_rate, notcar_rate))
+            # Recall of the cascade against the single stage classifier on test vehicles
+            single = svc.predict(X_test) == 1
+            passed = stage['svc'].decision_function(X_test[:, :n_stage_features]) >= stage['threshold']
+            print('Cascade keeps {:.4f} of the test vehicles found by the SVC'.format(
+                (single & passed)[y_test == 1].sum() / max(1, single[y_test == 1].sum())))
+            joblib.dump(stage, cascade_model_path)
+            print('Cascade stage saved')
+        else:
+            stage = None
 
     # Save classifier for later use
     joblib.dump(svc, svm_model_path)
     joblib.dump(X_scaler, scaler_model_path)
     print('SVM and Scaler model saved')
 
+    # Compact model read by detect_vehicles without sklearn
+    save_model(model_path, svc, X_scaler, svc_conf_thresh, cascade=stage)
+    print('Compact model saved to', model_path)
+
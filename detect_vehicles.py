@@ -1,186 +1,772 @@
 import os
-import matplotlib.pyplot as plt
-from sklearn.externals import joblib
-from scipy.ndimage.measurements import label
+from scipy.ndimage.measurements import label, find_objects
 from collections import deque
-from moviepy.editor import VideoFileClip
+from video_pipeline import VideoPipeline, output_frames_in_use
+from offline_video import process_video_offline
+from profiler import PipelineProfiler
+from nms import non_max_suppression_scores
+from numpy.lib.stride_tricks import sliding_window_view
+import classify_vehicles
 from classify_vehicles import *
 
-def track_vehicles(img, visualise=False):
-    # Image copy to draw detected vehicle boxes after heat maps
-    img_draw = np.copy(img)
-    # Image copy to draw detected vehicle boxes before heat maps
-    img_boxes = np.copy(img)
-    # Heat map to combine multiple scale detections
-    img_heat = np.zeros_like(img[:, :, 0]).astype(np.float)
-    # List to store detected windows at all image scales
-    all_detected_windows = []
-    # Uncomment the following line if you extracted training
-    # data from .png images (scaled 0 to 1 by mpimg) and the
-    # image you are searching is a .jpg (scaled 0 to 255)
-    # image = image.astype(np.float32)/255
-
-    # Calculate processing time per frame
-    t1 = time.time()
-    for i, scale in enumerate(scale_list):
-        # Apply image search region and window overlap for current scale
-        x_start = x_start_stop[i][0]
-        x_stop  = x_start_stop[i][1]
-        y_start = y_start_stop[i][0]
-        y_stop  = y_start_stop[i][1]
-        cells_per_xstep = cells_xstep_list[i]
-        cells_per_ystep = cells_ystep_list[i]
-        # Store detected windows for current scale
-        detected_windows = find_vehicles(img, scale, cells_per_xstep, cells_per_ystep,
-                                         x_start, x_stop, y_start, y_stop, visualise=visualise  )
-        # Add windows from each scale to final list for current image
-        all_detected_windows.extend(detected_windows)
-
-    # Remove windows of oldest frame if queue is full
-    if len(prev_detected_windows) == n_prev_windows:
-        prev_detected_windows.popleft()
-    # Add detected windows in current image to total windows list
-    prev_detected_windows.extend(all_detected_windows)
-    # Calculate heatmap over n_prev_windows
-    img_heat=add_heatmap(img_heat,heat_thresh, prev_detected_windows)
-    # Zero out pixels below the threshold
-    img_heat[img_heat < heat_thresh] = 0
-    # Calculate continuous region for each detected vehicle and number of detected vehicles
-    labels = label(img_heat)
-
-    t2 = time.time()
-    # Draw bounding boxes calculated from heatmap over n_prev_frames
-    img_draw  = draw_labeled_boxes(img_draw, labels)
-    # Draw all bounding boxes detected in current frame for visualisation
-    img_boxes = draw_boxes(img_boxes, all_detected_windows)
-
-    if visualise == True:
-        print('Detection time: ', round(t2 - t1, 2))
-        print(labels[1], 'Vehicles found')
-        fig = plt.figure()
-        plt.subplot(131)
-        plt.imshow(img_boxes)
-        plt.title('Bounding Boxes')
-        plt.subplot(132)
-        plt.imshow(img_draw)
-        plt.title('Detected Cars')
-        plt.subplot(133)
-        plt.imshow(img_heat, cmap='hot')
-        plt.title('Heat Map')
-        fig.tight_layout()
-        plt.show()
+# Vehicle detector holding the trained classifier and the sliding window search configuration.
+# Tracker state is kept per camera stream, so one detector can serve several streams.
+# The classifier is either a fitted svc and X_scaler, or a compact model loaded with load_model.
+class VehicleDetector(object):
+    def __init__(self, svc=None, X_scaler=None, scale_list=(2, 1.5, 1),
+                 x_start_stop=((300, 1280), (400, 1280), (360, 1280)),
+                 y_start_stop=((400, 700), (400, 560), (400, 528)),
+                 cells_xstep_list=(2, 2, 4), cells_ystep_list=(2, 2, 4),
+                 svc_conf_thresh=1.0, n_prev_frames=15, heat_thresh=7, label_downsample=1,
+                 nms_mode=None, nms_iou_thresh=0.5, use_heatmap=True, roi_tracking=False,
+                 full_scan_interval=10, roi_margin=0.5, roi_scale_range=(0.5, 1.5), roi_heat_thresh=4,
+                 entry_zones=((2, 300, 556, 400, 700, 2, 2), (2, 1024, 1280, 400, 700, 2, 2)),
+                 motion_gating=False, motion_thresh=2.0, motion_downsample=8, max_skipped_frames=2,
+                 cascade=None, model=None, lean=False, output_buffers=2, profiler=None):
+        # Optional first cascade stage scoring the leading features of each window, the HOG
+        # features of its first channels. Only windows above its threshold get the HOG features of
+        # the other channels and the SVM score.
+        self.cascade_weights = None
+        if model is not None:
+            check_model_params(model)
+            # SVM weights and bias acting directly on unscaled features
+            self.svc_weights, self.svc_bias = model['weights'], model['bias']
+            if 'cascade_weights' in model:
+                self.cascade_weights, self.cascade_bias = model['cascade_weights'], model['cascade_bias']
+                self.cascade_threshold = model['cascade_threshold']
+        else:
+            # SVM weights and bias acting directly on unscaled features
+            self.svc_weights, self.svc_bias = fold_scaler(svc, X_scaler)
+            # Cascade stage as saved by classify_vehicles
+            if cascade is not None:
+                self.cascade_weights, self.cascade_bias = fold_scaler(cascade['svc'], X_scaler,
+                                                                      n_features=cascade['n_features'])
+                self.cascade_threshold = cascade['threshold']
+        self.n_features = len(self.svc_weights)
+        # With a cascade, frames are planned with the HOG features of the channels the first stage
+        # sees, (first, stop), and the other channels are only computed for the windows it passes
+        self.stage_channels = None
+        if self.cascade_weights is not None:
+            self.stage_channels = (0, 3 * len(self.cascade_weights) // self.n_features)
+        # Lean mode: float32 scoring, an int16 heatmap, no debug drawing unless visualising, and
+        # vehicles drawn into output_buffers buffers reused in turn per stream, so a returned
+        # frame is overwritten output_buffers frames later
+        self.lean = lean
+        self.output_buffers = output_buffers
+        if lean:
+            self.svc_weights = np.asarray(self.svc_weights, dtype=np.float32)
+            self.svc_bias = np.float32(self.svc_bias)
+            if self.cascade_weights is not None:
+                self.cascade_weights = np.asarray(self.cascade_weights, dtype=np.float32)
+                self.cascade_bias = np.float32(self.cascade_bias)
+        # Scales to search for vehicle features in image
+        self.scale_list = list(scale_list)
+        # Region in x and y to search based on scale
+        self.x_start_stop = list(x_start_stop)
+        self.y_start_stop = list(y_start_stop)
+        # Overlap in cells per step x and y
+        self.cells_xstep_list = list(cells_xstep_list)
+        self.cells_ystep_list = list(cells_ystep_list)
+        # Classifier confidence above which detection is true
+        self.svc_conf_thresh = svc_conf_thresh
+        # Number of previous frames over which detected windows are checked
+        self.n_prev_frames = n_prev_frames
+        # Minumum number of times a pixel is present in a bounding box set to accept detection
+        self.heat_thresh = heat_thresh
+        # Heatmap downsampling factor before labeling vehicle regions
+        self.label_downsample = label_downsample
+        # Non-maximum suppression of detected windows: None, 'scale' within each scale or 'cross'
+        # across scales, suppressing windows with IoU above nms_iou_thresh
+        self.nms_mode = nms_mode
+        self.nms_iou_thresh = nms_iou_thresh
+        # Accumulate windows over n_prev_frames in a heatmap, otherwise report the windows of
+        # the current frame as vehicles (only sensible with nms_mode set)
+        self.use_heatmap = use_heatmap
+        # Search the whole frame only every full_scan_interval frames, or after a detection outside
+        # the known vehicles, and in between only regions of interest around the vehicles found
+        self.roi_tracking = roi_tracking
+        self.full_scan_interval = full_scan_interval
+        # Region of interest margin as a fraction of the vehicle box size on each side
+        self.roi_margin = roi_margin
+        # Scales searched around a vehicle box are those whose window side is within
+        # roi_scale_range times the box height
+        self.roi_scale_range = roi_scale_range
+        # Heat over n_prev_frames from which a region is searched, so vehicles below heat_thresh
+        # are still followed until they are confirmed, while windows detected in only a frame or
+        # two are not
+        self.roi_heat_thresh = roi_heat_thresh
+        # Regions searched in every frame for vehicles entering the view, in the same form as
+        # search_regions()
+        self.entry_zones = list(entry_zones)
+        # Reuse the windows of the last searched frame when the mean absolute grey level change
+        # of the search band, downsampled by motion_downsample, is below motion_thresh. At most
+        # max_skipped_frames frames in a row are skipped.
+        self.motion_gating = motion_gating
+        self.motion_thresh = motion_thresh
+        self.motion_downsample = motion_downsample
+        self.max_skipped_frames = max_skipped_frames
+        # Tracker state of each stream
+        self.streams = {}
+        # Reusable float32 window feature buffers by name and window boxes of each combination of
+        # layouts
+        self.features = {}
+        self.layout_boxes = {}
+        # Per-stage timings and window counts, off unless a profiler is given
+        self.profiler = profiler if profiler is not None else PipelineProfiler(enabled=False)
 
-    return img_draw
+    def search_regions(self):
+        # (scale, x_start, x_stop, y_start, y_stop, cells_per_xstep, cells_per_ystep) per scale
+        return [(scale, self.x_start_stop[i][0], self.x_start_stop[i][1],
+                 self.y_start_stop[i][0], self.y_start_stop[i][1],
+                 self.cells_xstep_list[i], self.cells_ystep_list[i])
+                for i, scale in enumerate(self.scale_list)]
+
+    # Regions of interest around the vehicle regions of a stream, at the scales consistent with
+    # the size of each region, clipped to the search region of the scale
+    def roi_regions(self, regions):
+        rois = []
+        window_sizes = [train_img_width * scale for scale in self.scale_list]
+        for region in regions:
+            x1, y1 = region[REGION_X1], region[REGION_Y1]
+            x2, y2 = region[REGION_X2] + 1, region[REGION_Y2] + 1
+            width, height = x2 - x1, y2 - y1
+            scales = [i for i, size in enumerate(window_sizes)
+                      if self.roi_scale_range[0] * height <= size <= self.roi_scale_range[1] * height]
+            if not scales:
+                scales = [int(np.argmin([abs(size - height) for size in window_sizes]))]
+            for i in scales:
+                x_start, x_stop = self.x_start_stop[i]
+                y_start, y_stop = self.y_start_stop[i]
+                # Expand by the margin and snap to a coarse grid, so window layouts are reused
+                x_start = max(x_start, int(x1 - self.roi_margin * width) // ROI_GRID * ROI_GRID)
+                x_stop = min(x_stop, -(-int(x2 + self.roi_margin * width) // ROI_GRID) * ROI_GRID)
+                y_start = max(y_start, int(y1 - self.roi_margin * height) // ROI_GRID * ROI_GRID)
+                y_stop = min(y_stop, -(-int(y2 + self.roi_margin * height) // ROI_GRID) * ROI_GRID)
+                # Skip regions that cannot hold a single window at this scale
+                if min(x_stop - x_start, y_stop - y_start) < window_sizes[i]:
+                    continue
+                rois.append((self.scale_list[i], x_start, x_stop, y_start, y_stop,
+                             self.cells_xstep_list[i], self.cells_ystep_list[i]))
+        return rois
+
+    # Bounding box (x_start, x_stop, y_start, y_stop) of all search regions
+    def search_band(self):
+        regions = np.array([region[1:5] for region in self.search_regions()])
+        return regions[:, 0].min(), regions[:, 1].max(), regions[:, 2].min(), regions[:, 3].max()
+
+    # Downsampled grey level search band of a frame, compared between frames for motion gating
+    def motion_frame(self, img):
+        x_start, x_stop, y_start, y_stop = self.search_band()
+        band = cv2.cvtColor(img[y_start:y_stop, x_start:x_stop], cv2.COLOR_RGB2GRAY)
+        return cv2.resize(band, (band.shape[1] // self.motion_downsample, band.shape[0] // self.motion_downsample),
+                          interpolation=cv2.INTER_AREA)
+
+    # Decide whether the next frame of a stream can reuse the windows of the last searched frame.
+    # Frames are compared with the last searched frame, so slow drifts still trigger a search.
+    def skip_frame(self, img, stream_id=0):
+        if not self.motion_gating:
+            return False
+        state = self.stream(stream_id)
+        state.n_frames += 1
+        with self.profiler.stage('motion'):
+            motion_frame = self.motion_frame(img)
+            skip = state.motion_frame is not None and state.skipped_frames < self.max_skipped_frames and \
+                motion_frame.shape == state.motion_frame.shape and \
+                cv2.absdiff(motion_frame, state.motion_frame).mean() < self.motion_thresh
+        if skip:
+            state.skipped_frames += 1
+        else:
+            state.motion_frame = motion_frame
+            state.skipped_frames = 0
+            state.n_searched_frames += 1
+        self.profiler.count('searched', 0 if skip else 1)
+        return skip
+
+    # Fraction of the frames of a stream that were searched rather than reusing windows
+    def detection_rate(self, stream_id=0):
+        state = self.stream(stream_id)
+        return state.n_searched_frames / state.n_frames if state.n_frames else 1.
+
+    def stream(self, stream_id):
+        if stream_id not in self.streams:
+            # Windows only ever cover the search band, so the heatmap is limited to its rows
+            _, _, y_start, y_stop = self.search_band()
+            self.streams[stream_id] = StreamState(self.n_prev_frames, heat_rows=(y_start, y_stop),
+                                                  heat_dtype=np.int16 if self.lean else np.int32)
+        return self.streams[stream_id]
+
+    def reset_stream(self, stream_id):
+        self.streams.pop(stream_id, None)
+
+    def score(self, features):
+        # Classifier decision values of complete window features, as frame_candidates returns
+        # them, with the scaler folded into the SVM weights
+        if self.cascade_weights is None:
+            return features.dot(self.svc_weights) + self.svc_bias
+        # Windows rejected by the first stage get a score no threshold accepts
+        stage_scores = features[:, :len(self.cascade_weights)].dot(self.cascade_weights) + self.cascade_bias
+        passed = np.flatnonzero(stage_scores >= self.cascade_threshold)
+        self.profiler.count('cascade_passed', len(passed))
+        scores = np.full(len(features), -np.inf, dtype=stage_scores.dtype)
+        scores[passed] = features[passed].dot(self.svc_weights) + self.svc_bias
+        return scores
+
+    def accept(self, scores):
+        # Positive prediction and confidence above threshold
+        return (scores > 0) & (scores > self.svc_conf_thresh)
+
+    # Search one scale and region of an image and return the detected windows
+    def find_vehicles(self, img, scale, cells_per_xstep, cells_per_ystep, x_start, x_stop, y_start, y_stop,
+                      visualise=False, pyramid=None):
+        # Build a single-scale pyramid if the caller does not share one across scales
+        if pyramid is None:
+            pyramid = FeaturePyramid(img, [(scale, x_start, x_stop, y_start, y_stop)], profiler=self.profiler)
+        if visualise == True:
+            print(scale, x_start, x_stop, y_start, y_stop)
+        features, boxes = window_features(pyramid, scale, cells_per_xstep, cells_per_ystep,
+                                          x_start, x_stop, y_start, y_stop)
+        return self.select_windows(features, boxes, visualise=visualise)
+
+    def select_windows(self, features, boxes, scores=None, visualise=False):
+        # Windows whose features the classifier accepts, as ((x1, y1), (x2, y2))
+        with self.profiler.stage('classify'):
+            if scores is None:
+                scores = self.score(features)
+            detected = np.flatnonzero(self.accept(scores))
+        self.profiler.count('accepted', len(detected))
+        if self.nms_mode is not None and len(detected) > 1:
+            with self.profiler.stage('nms'):
+                # Window side length identifies the scale of a window
+                groups = boxes[detected, 2] - boxes[detected, 0] if self.nms_mode == 'scale' else None
+                keep = non_max_suppression_scores(boxes[detected], scores[detected], self.nms_iou_thresh,
+                                                  groups=groups)
+                detected = detected[np.sort(keep)]
+            self.profiler.count('after_nms', len(detected))
+        if visualise == True:
+            for idx in detected:
+                print('Confidence: ', scores[idx])
+        return boxes_to_windows(boxes[detected])
+
+    # Feature buffer holding n_windows rows, reused from frame to frame
+    def feature_buffer(self, n_windows, n_features, name='features'):
+        features = self.features.get(name)
+        if features is None or len(features) < n_windows or features.shape[1] != n_features:
+            features = self.features[name] = np.empty((max(n_windows, 1), n_features), dtype=np.float32)
+        return features[:n_windows]
+
+    # Plan the search of an image: the feature pyramids, the window layout and HOG blocks of every
+    # search region, and the boxes of all windows in order. Without search_regions the frame is
+    # searched at all scales through one shared pyramid. Given regions of interest, merged so no
+    # two of a scale overlap, each gets its own pyramid, so far apart regions of a scale do not
+    # compute HOG features of the gap. Only the HOG features of channels (first, stop) are computed
+    # if given.
+    def frame_plan(self, img, search_regions=None, visualise=False, channels=None):
+        full_scan = search_regions is None
+        if full_scan:
+            search_regions = self.search_regions()
+            # Colour conversion and HOG features shared by all scales of this frame
+            pyramid = FeaturePyramid(img, [region[:5] for region in search_regions], profiler=self.profiler)
+            pyramids = [pyramid] * len(search_regions)
+        else:
+            # Colour conversion shared by all regions
+            pyramids = []
+            img_conv = None
+            for region in search_regions:
+                pyramids.append(FeaturePyramid(img, [region[:5]], profiler=self.profiler, img_conv=img_conv))
+                img_conv = pyramids[-1].convert()
+        layouts = []
+        for pyramid, region in zip(pyramids, search_regions):
+            scale, x_start, x_stop, y_start, y_stop, cells_per_xstep, cells_per_ystep = region
+            if visualise == True:
+                print(scale, x_start, x_stop, y_start, y_stop)
+            layouts.append(region_layout(pyramid, scale, cells_per_xstep, cells_per_ystep,
+                                         x_start, x_stop, y_start, y_stop, channels=channels) + (region[:5],))
+        key = tuple(layout for layout, _, _ in layouts)
+        if not full_scan:
+            # Regions of interest move from frame to frame, so their boxes are not cached
+            boxes = np.vstack([layout.boxes for layout in key] + [np.zeros((0, 4), dtype=np.intp)])
+        else:
+            if key not in self.layout_boxes:
+                self.layout_boxes[key] = np.vstack([layout.boxes for layout in key])
+            boxes = self.layout_boxes[key]
+        return pyramids, layouts, boxes
+
+    # Plan the search of the next frame of a stream. In ROI tracking mode this is a full scan
+    # every full_scan_interval frames or when requested, otherwise the regions of interest around
+    # the vehicles of the stream and the entry zones.
+    def stream_plan(self, img, stream_id=0, visualise=False):
+        if not self.roi_tracking:
+            return self.frame_plan(img, visualise=visualise, channels=self.stage_channels)
+        state = self.stream(stream_id)
+        if state.full_scan_countdown <= 0 or state.force_full_scan or state.rois is None:
+            state.full_scan_countdown = self.full_scan_interval - 1
+            state.force_full_scan = False
+            state.rois = self.search_regions()
+            self.profiler.count('full_scan', 1)
+            return self.frame_plan(img, visualise=visualise, channels=self.stage_channels)
+        state.full_scan_countdown -= 1
+        state.rois = merge_search_regions(self.roi_regions(state.roi_source))
+        self.profiler.count('rois', len(state.rois))
+        return self.frame_plan(img, search_regions=merge_search_regions(state.rois + self.entry_zones),
+                               visualise=visualise, channels=self.stage_channels)
+
+    # Request a full scan of the next frame of a stream if a window was detected outside the
+    # regions of interest searched, which can only happen in an entry zone
+    def check_new_vehicles(self, windows, stream_id=0):
+        if not self.roi_tracking or not windows:
+            return
+        state = self.stream(stream_id)
+        boxes = np.array(windows, dtype=np.intp).reshape(-1, 4)
+        rois = np.array([roi[1:5] for roi in state.rois], dtype=np.intp).reshape(-1, 4)
+        x_center = (boxes[:, 0:1] + boxes[:, 2:3]) // 2
+        y_center = (boxes[:, 1:2] + boxes[:, 3:4]) // 2
+        inside = (x_center >= rois[:, 0]) & (x_center < rois[:, 1]) & \
+                 (y_center >= rois[:, 2]) & (y_center < rois[:, 3])
+        if not inside.any(axis=1).all():
+            state.force_full_scan = True
+
+    # Gather the window features of a frame plan into features, one row per window, then drop the
+    # cached features of the frame unless clear is False
+    def gather(self, plan, features, clear=True):
+        pyramids, layouts, _ = plan
+        first = 0
+        for layout, hogs, _ in layouts:
+            with self.profiler.stage('gather/{}'.format(layout.scale)):
+                layout.gather(hogs, features[first:first + layout.n_windows])
+            self.profiler.count('windows/{}'.format(layout.scale), layout.n_windows)
+            first += layout.n_windows
+        if clear:
+            for pyramid in set(pyramids):
+                pyramid.clear()
+        return features
+
+    # Gather the features of the channels after the first stage channels for the windows of a frame
+    # plan at index into features, computing their HOG features over the blocks those windows cover
+    def gather_passed(self, plan, index, features):
+        pyramids, layouts, _ = plan
+        channels = (self.stage_channels[1], 3)
+        first = 0
+        row = 0
+        for pyramid, (layout, _, region) in zip(pyramids, layouts):
+            layout_index = index[(index >= first) & (index < first + layout.n_windows)] - first
+            if len(layout_index):
+                hogs = pyramid.hog_region(*region, channels=channels, rects=layout.block_rects(layout_index))[0]
+                with self.profiler.stage('gather/{}'.format(layout.scale)):
+                    layout.gather(hogs, features[row:row + len(layout_index)], index=layout_index)
+                row += len(layout_index)
+            first += layout.n_windows
+        return features
+
+    # Scores of the windows of each frame plan, None for plans that are None. Without a cascade
+    # the windows of all plans are gathered and scored together. With a cascade the plans hold
+    # the HOG features of the first stage channels only, which score every window. Only windows
+    # passing the first stage get the HOG features of the other channels and the SVM score, the
+    # others score -inf.
+    def plan_scores(self, plans):
+        offsets = np.cumsum([0] + [0 if plan is None else len(plan[2]) for plan in plans])
+        if self.cascade_weights is None:
+            features = self.feature_buffer(offsets[-1], self.n_features)
+            for plan, first, last in zip(plans, offsets[:-1], offsets[1:]):
+                if plan is not None:
+                    self.gather(plan, features[first:last])
+            with self.profiler.stage('classify'):
+                scores = self.score(features)
+        else:
+            n_stage_features = len(self.cascade_weights)
+            stage_features = self.feature_buffer(offsets[-1], n_stage_features, name='stage')
+            for plan, first, last in zip(plans, offsets[:-1], offsets[1:]):
+                if plan is not None:
+                    self.gather(plan, stage_features[first:last], clear=False)
+            with self.profiler.stage('classify'):
+                stage_scores = stage_features.dot(self.cascade_weights) + self.cascade_bias
+                passed = np.flatnonzero(stage_scores >= self.cascade_threshold)
+            self.profiler.count('cascade_passed', len(passed))
+            features = self.feature_buffer(len(passed), self.n_features)
+            features[:, :n_stage_features] = stage_features[passed]
+            other_features = self.feature_buffer(len(passed), self.n_features - n_stage_features, name='other')
+            row = 0
+            for plan, first, last in zip(plans, offsets[:-1], offsets[1:]):
+                if plan is not None:
+                    index = passed[(passed >= first) & (passed < last)] - first
+                    self.gather_passed(plan, index, other_features[row:row + len(index)])
+                    row += len(index)
+                    for pyramid in set(plan[0]):
+                        pyramid.clear()
+            features[:, n_stage_features:] = other_features
+            with self.profiler.stage('classify'):
+                scores = np.full(offsets[-1], -np.inf, dtype=stage_scores.dtype)
+                scores[passed] = features.dot(self.svc_weights) + self.svc_bias
+        return [None if plan is None else scores[first:last]
+                for plan, first, last in zip(plans, offsets[:-1], offsets[1:])]
+
+    # Features and boxes of the candidate windows of an image at all scales. The features are
+    # held in a buffer reused by the next call.
+    def frame_candidates(self, img, visualise=False):
+        plan = self.frame_plan(img, visualise=visualise)
+        boxes = plan[2]
+        return self.gather(plan, self.feature_buffer(len(boxes), self.n_features)), boxes
+
+    # Stateless per-frame search: return windows detected at all image scales
+    def detect_windows(self, img, visualise=False):
+        plan = self.frame_plan(img, visualise=visualise, channels=self.stage_channels)
+        return self.select_windows(None, plan[2], scores=self.plan_scores([plan])[0], visualise=visualise)
+
+    # Search the next frame of a stream, following its vehicles in ROI tracking mode
+    def detect_stream_windows(self, img, stream_id=0, visualise=False):
+        plan = self.stream_plan(img, stream_id=stream_id, visualise=visualise)
+        windows = self.select_windows(None, plan[2], scores=self.plan_scores([plan])[0], visualise=visualise)
+        self.check_new_vehicles(windows, stream_id=stream_id)
+        return windows
+
+    # Sequential temporal stage: accumulate a frame's detected windows into the heatmap history
+    # of its stream and draw the vehicles found over n_prev_frames. Frames must be passed in order.
+    def track_windows(self, img, all_detected_windows, stream_id=0, visualise=False, t_start=None):
+        if self.use_heatmap:
+            heat_history = self.stream(stream_id).heat_history
+            with self.profiler.stage('heatmap'):
+                # Add detected windows in current image to the heatmap history, evicting the oldest frame
+                heat_history.update(all_detected_windows, img.shape[:2])
+                # Heatmap combining multiple scale detections over n_prev_frames
+                img_heat = heat_history.heatmap()
+                if self.roi_tracking and self.roi_heat_thresh < self.heat_thresh:
+                    roi_heat = img_heat >= self.roi_heat_thresh
+                # Zero out pixels below the threshold
+                img_heat[img_heat < self.heat_thresh] = 0
+            with self.profiler.stage('label'):
+                # Calculate continuous region, bounding box and statistics for each detected vehicle
+                regions = labeled_regions(img_heat, downsample=self.label_downsample,
+                                          y_offset=heat_history.y_start)
+                if self.roi_tracking:
+                    # Regions with any recent heat are followed until confirmed or gone. They are
+                    # expanded and snapped to the ROI grid anyway, so they are labeled at that grid.
+                    self.stream(stream_id).roi_source = regions if self.roi_heat_thresh >= self.heat_thresh \
+                        else labeled_regions(roi_heat, downsample=ROI_GRID, y_offset=heat_history.y_start)
+        else:
+            # Windows left after non-maximum suppression are the vehicles of this frame
+            img_heat = add_heatmap(np.zeros(img.shape[:2], dtype=np.int32), 0, all_detected_windows) \
+                if visualise == True else None
+            regions = window_regions(all_detected_windows)
+            if self.roi_tracking:
+                self.stream(stream_id).roi_source = regions
+        self.stream(stream_id).regions = regions
+        self.profiler.count('vehicles', len(regions))
+
+        t2 = time.time()
+        with self.profiler.stage('draw'):
+            if self.lean:
+                # Frame copied into the next reused output buffer of the stream
+                img_draw = self.stream(stream_id).output_buffer(img, self.output_buffers)
+            else:
+                # Image copy to draw detected vehicle boxes after heat maps
+                img_draw = np.copy(img)
+            # Draw bounding boxes calculated from heatmap over n_prev_frames
+            img_draw  = draw_labeled_boxes(img_draw, regions)
+            if visualise == True or not self.lean:
+                # Image copy to draw detected vehicle boxes before heat maps
+                img_boxes = np.copy(img)
+                # Draw all bounding boxes detected in current frame for visualisation
+                img_boxes = draw_boxes(img_boxes, all_detected_windows)
+
+        if visualise == True:
+            if t_start is not None:
+                print('Detection time: ', round(t2 - t_start, 2))
+            print(len(regions), 'Vehicles found')
+            import matplotlib.pyplot as plt
+            fig = plt.figure()
+            plt.subplot(131)
+            plt.imshow(img_boxes)
+            plt.title('Bounding Boxes')
+            plt.subplot(132)
+            plt.imshow(img_draw)
+            plt.title('Detected Cars')
+            plt.subplot(133)
+            plt.imshow(img_heat, cmap='hot')
+            plt.title('Heat Map')
+            fig.tight_layout()
+            plt.show()
+
+        return img_draw
+
+    def track_vehicles(self, img, stream_id=0, visualise=False):
+        # Calculate processing time per frame
+        t1 = time.time()
+        self.profiler.start_frame(stream_id)
+        # Search the frame unless it barely changed, then update the detections over previous frames
+        if self.skip_frame(img, stream_id=stream_id):
+            all_detected_windows = self.stream(stream_id).windows
+        else:
+            all_detected_windows = self.detect_stream_windows(img, stream_id=stream_id, visualise=visualise)
+            self.stream(stream_id).windows = all_detected_windows
+        img_draw = self.track_windows(img, all_detected_windows, stream_id=stream_id, visualise=visualise, t_start=t1)
+        self.profiler.end_frame()
+        return img_draw
+
+    # Track one frame from each of several streams, scoring the windows of all frames in a single
+    # classifier call. Frames of the same stream are tracked in the order given, though in ROI
+    # tracking mode their search regions all come from the stream state before the batch.
+    # Frames skipped by motion gating reuse the windows of the last searched frame of their stream.
+    # The whole batch is profiled as one record of stream 'batch'.
+    def process_batch(self, frames, stream_ids):
+        self.profiler.start_frame('batch')
+        plans = [None if self.skip_frame(img, stream_id=stream_id) else self.stream_plan(img, stream_id=stream_id)
+                 for img, stream_id in zip(frames, stream_ids)]
+        # Gather the windows of all frames into one buffer and score them together
+        frames_out = []
+        for img, stream_id, plan, scores in zip(frames, stream_ids, plans, self.plan_scores(plans)):
+            if plan is None:
+                windows = self.stream(stream_id).windows
+            else:
+                windows = self.select_windows(None, plan[2], scores=scores)
+                self.check_new_vehicles(windows, stream_id=stream_id)
+                self.stream(stream_id).windows = windows
+            frames_out.append(self.track_windows(img, windows, stream_id=stream_id))
+        self.profiler.end_frame()
+        return frames_out
+
+# Tracker state of one camera stream
+class StreamState(object):
+    def __init__(self, n_prev_frames, heat_rows=None, heat_dtype=np.int32):
+        # Detected windows and their heatmap over n_prev_frames
+        self.heat_history = HeatmapHistory(n_prev_frames, rows=heat_rows, dtype=heat_dtype)
+        # Output frames reused in turn in lean mode
+        self.outputs = []
+        self.next_output = 0
+        # Vehicle regions of the last frame, as returned by labeled_regions
+        self.regions = np.zeros((0, 6), dtype=np.int64)
+        # ROI tracking: vehicle regions to search around, regions searched in the last frame,
+        # frames left until the next full scan and whether the next frame must be a full scan
+        self.roi_source = np.zeros((0, 6), dtype=np.int64)
+        self.rois = None
+        self.full_scan_countdown = 0
+        self.force_full_scan = False
+        # Motion gating: windows and downsampled search band of the last searched frame, frames
+        # skipped since, and frames seen and searched
+        self.windows = []
+        self.motion_frame = None
+        self.skipped_frames = 0
+        self.n_frames = 0
+        self.n_searched_frames = 0
+
+    # Copy img into the next of n_buffers reused output buffers and return it
+    def output_buffer(self, img, n_buffers):
+        if len(self.outputs) != n_buffers or self.outputs[0].shape != img.shape:
+            self.outputs = [np.empty_like(img) for _ in range(n_buffers)]
+            self.next_output = 0
+        output = self.outputs[self.next_output]
+        self.next_output = (self.next_output + 1) % n_buffers
+        np.copyto(output, img)
+        return output
+
+# Per-frame cache of the colour converted frame and of HOG features at each search scale
+class FeaturePyramid(object):
+    def __init__(self, img, search_regions, profiler=None, img_conv=None):
+        self.img = img
+        # Colour converted frame, when already converted for another pyramid
+        self.img_conv = img_conv
+        self.profiler = profiler if profiler is not None else PipelineProfiler(enabled=False)
+        # Union of the search regions sharing each scale, as [x_start, x_stop, y_start, y_stop]
+        self.level_regions = {}
+        for scale, x_start, x_stop, y_start, y_stop in search_regions:
+            if scale in self.level_regions:
+                region = self.level_regions[scale]
+                region[0] = min(region[0], x_start)
+                region[1] = max(region[1], x_stop)
+                region[2] = min(region[2], y_start)
+                region[3] = max(region[3], y_stop)
+            else:
+                self.level_regions[scale] = [x_start, x_stop, y_start, y_stop]
+        # Resized colour levels per scale and their HOG features per scale and channel range,
+        # computed on first use
+        self.images = {}
+        self.levels = {}
+
+    def convert(self):
+        # Convert image to colour space used in SVM classifier training, once per frame
+        if self.img_conv is None:
+            with self.profiler.stage('convert'):
+                self.img_conv = cv2.cvtColor(self.img, cv2.COLOR_RGB2YUV)
+        return self.img_conv
+
+    def image(self, scale):
+        # Resize the union of search regions for this scale once
+        if scale not in self.images:
+            x_start, x_stop, y_start, y_stop = self.level_regions[scale]
+            img_search = self.convert()[y_start:y_stop, x_start:x_stop, :]
+            with self.profiler.stage('resize/{}'.format(scale)):
+                self.images[scale] = cv2.resize(img_search, (np.int(img_search.shape[1] / scale),
+                                                             np.int(img_search.shape[0] / scale)))
+        return self.images[scale]
+
+    def level(self, scale, channels=None):
+        # HOG features of the channels (first, stop) of the level, all channels by default, for
+        # the entire level in one pass
+        channels = channels or (0, self.img.shape[2])
+        if (scale, channels) not in self.levels:
+            img_search = self.image(scale)[:, :, channels[0]:channels[1]]
+            with self.profiler.stage('hog/{}'.format(scale)):
+                self.levels[scale, channels] = get_hog_features_fast(img_search, orient, pix_per_cell,
+                                                                      cell_per_block)
+        return self.levels[scale, channels]
+
+    # HOG features of the channels (first, stop) of the level computed only for the blocks inside
+    # rects, as (y_start, y_stop, x_start, x_stop) block ranges, with zeros elsewhere. Each rect
+    # is computed with a margin of one cell, so its blocks equal those of the whole level.
+    def level_blocks(self, scale, channels, rects):
+        img_search = self.image(scale)[:, :, channels[0]:channels[1]]
+        height, width = img_search.shape[:2]
+        hogs = np.zeros((channels[1] - channels[0],) + self.level_shape(scale) + (cell_per_block, cell_per_block, orient))
+        with self.profiler.stage('hog_blocks/{}'.format(scale)):
+            for y_block, y_stop, x_block, x_stop in rects:
+                y_cell = max(0, y_block - 1)
+                x_cell = max(0, x_block - 1)
+                crop = img_search[y_cell * pix_per_cell:min(height, (y_stop + cell_per_block) * pix_per_cell),
+                                  x_cell * pix_per_cell:min(width, (x_stop + cell_per_block) * pix_per_cell)]
+                crop_hogs = get_hog_features_fast(crop, orient, pix_per_cell, cell_per_block)
+                hogs[:, y_block:y_stop, x_block:x_stop] = \
+                    crop_hogs[:, y_block - y_cell:y_stop - y_cell, x_block - x_cell:x_stop - x_cell]
+        return hogs
 
-# Define a single function that can extract features using hog sub-sampling and make predictions
-def find_vehicles(img, scale, cells_per_xstep, cells_per_ystep, x_start, x_stop,y_start, y_stop, visualise=False):
-    # Convert image to colour space used in SVM classifier training
-    img_conv = cv2.cvtColor(img, cv2.COLOR_RGB2YUV)
-    img_search = img_conv[y_start:y_stop, x_start:x_stop, :]
-    img_search = cv2.resize(img_search, (np.int(img_search.shape[1] / scale),
-                                             np.int(img_search.shape[0] / scale)))
-
-    ch1 = img_search[:, :, 0]
-    ch2 = img_search[:, :, 1]
-    ch3 = img_search[:, :, 2]
-    # Compute individual channel HOG features for the entire image
-    hog1 = get_hog_features(ch1, orient, pix_per_cell, cell_per_block, feature_vec=False)
-    hog2 = get_hog_features(ch2, orient, pix_per_cell, cell_per_block, feature_vec=False)
-    hog3 = get_hog_features(ch3, orient, pix_per_cell, cell_per_block, feature_vec=False)
-
-    # Define blocks in image in x and y
-    nxblocks = (ch1.shape[1] // pix_per_cell) - cell_per_block + 1
-    nyblocks = (ch1.shape[0] // pix_per_cell) - cell_per_block + 1
-
-    # 64 pixels was the original training window, with 3 cells and 6 pix per cell
-    window = train_img_width
-    nwinblocks = (window // pix_per_cell) - cell_per_block + 1
-    nxsteps = (nxblocks - nwinblocks) // cells_per_xstep
-    nysteps = (nyblocks - nwinblocks) // cells_per_ystep
-
-    if visualise == True:
-        print(scale, x_start, x_stop, y_start, y_stop)
-
-    # Initialize a list to append window positions to
-    window_list = []
-    for xb in range(nxsteps):
-        for yb in range(nysteps):
-            # Define an empty list to receive features
-            img_features = []
-            ypos = yb * cells_per_ystep
-            xpos = xb * cells_per_xstep
-            xleft = xpos * pix_per_cell
-            ytop = ypos * pix_per_cell
-
-            '''if use_spatial == True or use_hist == True:
-                # Extract the image patch
-                subimg = cv2.resize(img_search[ytop:ytop + window, xleft:xleft + window], (train_img_height, train_img_width))
-            # Get color features
-            if use_spatial == True:
-                spatial_features = bin_spatial(subimg, size=spatial_size)
-                img_features.append(spatial_features)
-            if use_hist == True:
-                hist_features = color_hist(subimg, nbins=hist_bins)
-                img_features.append(hist_features)
-            '''
-            # Extract HOG for all channels in this patch
-            hog_feat1 = hog1[ypos:ypos + nwinblocks, xpos:xpos + nwinblocks].ravel()
-            hog_feat2 = hog2[ypos:ypos + nwinblocks, xpos:xpos + nwinblocks].ravel()
-            hog_feat3 = hog3[ypos:ypos + nwinblocks, xpos:xpos + nwinblocks].ravel()
-            hog_features = np.hstack((hog_feat1, hog_feat2, hog_feat3))
-            img_features.append(hog_features)
-            feature_vector = np.concatenate(img_features).astype(np.float64)
-            # Scale features and make a prediction
-            test_features = X_scaler.transform(feature_vector.reshape(1, -1))
-            test_prediction = svc.predict(test_features)
-
-            if test_prediction == 1:
-                if visualise == True:
-                    print('Confidence: ', svc.decision_function(test_features))
-                if svc.decision_function(test_features) > svc_conf_thresh:
-                    win_scaled = np.int(window * scale)
-                    startx = np.int(xleft * scale) + x_start
-                    starty = np.int(ytop * scale) + y_start
-                    endx = startx + win_scaled
-                    endy = starty + win_scaled
-                    # Append window position to list
-                    window_list.append(((startx, starty), (endx, endy)))
-                    '''if visualise == True:
-                        if scale == 3:
-                            colour_tuple = (255, 0, 0)
-                        elif scale == 2:
-                            colour_tuple = (0, 255, 0)
-                        elif scale == 1.5:
-                            colour_tuple = (0, 0, 255)
-                        else:
-                            colour_tuple = (255,255,0)
-                        cv2.rectangle(img_local, (startx, starty), (endx, endy), colour_tuple, 2)
-                        plt.imshow(img_local)
-                        plt.show()
-                    '''
-            '''if visualise == True and TEST_ON_VIDEO == False:
-                img_local = np.copy(img)
-                if scale == 3:
-                    colour_tuple = (255, 0, 0)
-                elif scale == 2:
-                    colour_tuple = (0, 255, 0)
-                elif scale == 1.5:
-                    colour_tuple = (0, 0, 255)
-                else:
-                    colour_tuple = (255, 255, 0)
-                win_scaled = np.int(window * scale)
-                startx = np.int(xleft * scale) + x_start
-                starty = np.int(ytop * scale) + y_start
-                endx = startx + win_scaled
-                endy = starty + win_scaled
-                cv2.rectangle(img_local, (startx, starty),(endx, endy), colour_tuple, 2)
-            '''
-
-    '''if visualise == True and TEST_ON_VIDEO == False:
-        plt.imshow(img_local)
-        plt.show()
-    '''
-    return window_list
+    # Block shape (n_blocks_y, n_blocks_x) of the HOG features of a level
+    def level_shape(self, scale):
+        height, width = self.image(scale).shape[:2]
+        return max(0, height // pix_per_cell - cell_per_block + 1), max(0, width // pix_per_cell - cell_per_block + 1)
+
+    def hog_region(self, scale, x_start, x_stop, y_start, y_stop, channels=None, rects=None):
+        # Return a view (channels, n_blocks_y, n_blocks_x, ...) of the cached HOG blocks covering
+        # one search region, the pixel origin of the views in the scaled level, and the frame
+        # position of the level. Given rects, block ranges of the region as in level_blocks, only
+        # those blocks are computed, for the channels (first, stop).
+        if scale not in self.level_regions:
+            self.level_regions[scale] = [x_start, x_stop, y_start, y_stop]
+        n_blocks_y, n_blocks_x = self.level_shape(scale)
+        x_level, _, y_level, _ = self.level_regions[scale]
+        # First whole cell inside the region and number of blocks the region spans
+        x_cell = int(np.ceil((x_start - x_level) / scale / pix_per_cell))
+        y_cell = int(np.ceil((y_start - y_level) / scale / pix_per_cell))
+        nxblocks = (np.int((x_stop - x_start) / scale) // pix_per_cell) - cell_per_block + 1
+        nyblocks = (np.int((y_stop - y_start) / scale) // pix_per_cell) - cell_per_block + 1
+        nxblocks = max(0, min(nxblocks, n_blocks_x - x_cell))
+        nyblocks = max(0, min(nyblocks, n_blocks_y - y_cell))
+        if rects is None:
+            hogs = self.level(scale, channels)
+        else:
+            rects = [(y_block + y_cell, y_stop + y_cell, x_block + x_cell, x_stop + x_cell)
+                     for y_block, y_stop, x_block, x_stop in rects]
+            hogs = self.level_blocks(scale, channels, rects)
+        views = hogs[:, y_cell:y_cell + nyblocks, x_cell:x_cell + nxblocks]
+        return views, x_cell * pix_per_cell, y_cell * pix_per_cell, x_level, y_level
+
+    def clear(self):
+        self.img_conv = None
+        self.images.clear()
+        self.levels.clear()
+
+# Window layouts cached by HOG region shape, scale, steps and region position, cleared when
+# it reaches window_layout_cache_size since regions of interest keep moving
+window_layout_cache = {}
+window_layout_cache_size = 4096
+
+# Precomputed sliding window layout of one scale and search region: the window grid, the boxes
+# of the windows in the frame and the feature length. Layouts only depend on the geometry, so
+# they are built once and reused for every frame.
+class WindowLayout(object):
+    def __init__(self, nyblocks, nxblocks, scale, cells_per_xstep, cells_per_ystep,
+                 x_origin, y_origin, x_level, y_level):
+        self.scale = scale
+        self.cells_per_xstep = cells_per_xstep
+        self.cells_per_ystep = cells_per_ystep
+        # 64 pixels was the original training window, with 3 cells and 6 pix per cell
+        window = train_img_width
+        self.nwinblocks = (window // pix_per_cell) - cell_per_block + 1
+        self.nxsteps = max(0, (nxblocks - self.nwinblocks) // cells_per_xstep)
+        self.nysteps = max(0, (nyblocks - self.nwinblocks) // cells_per_ystep)
+        self.n_windows = self.nxsteps * self.nysteps
+        self.n_channel_features = self.nwinblocks * self.nwinblocks * cell_per_block * cell_per_block * orient
+        self.n_features = 3 * self.n_channel_features
+
+        # Window positions in HOG cells, ordered x-major as in the per-window search
+        xpos = np.repeat(np.arange(self.nxsteps) * cells_per_xstep, self.nysteps)
+        ypos = np.tile(np.arange(self.nysteps) * cells_per_ystep, self.nxsteps)
+        # Window boxes in the frame as rows of (x1, y1, x2, y2)
+        win_scaled = np.int(window * scale)
+        self.boxes = np.empty((self.n_windows, 4), dtype=np.intp)
+        self.boxes[:, 0] = ((x_origin + xpos * pix_per_cell) * scale).astype(np.intp) + x_level
+        self.boxes[:, 1] = ((y_origin + ypos * pix_per_cell) * scale).astype(np.intp) + y_level
+        self.boxes[:, 2] = self.boxes[:, 0] + win_scaled
+        self.boxes[:, 3] = self.boxes[:, 1] + win_scaled
+        self.boxes.flags.writeable = False
+
+    # Copy the HOG blocks of every window, or of the windows at index, into out, an
+    # (n_windows x n_features) array, through strided views of hogs, the
+    # (channels, n_blocks_y, n_blocks_x, ...) HOG region
+    def gather(self, hogs, out, index=None):
+        if self.n_windows == 0:
+            return out
+        nwinblocks = self.nwinblocks
+        # (channels, y, x, cell_per_block, cell_per_block, orient, nwinblocks, nwinblocks) view of
+        # all windows, keeping the windows on the step grid
+        windows = sliding_window_view(hogs, (nwinblocks, nwinblocks), axis=(1, 2))
+        windows = windows[:, :self.nysteps * self.cells_per_ystep:self.cells_per_ystep,
+                          :self.nxsteps * self.cells_per_xstep:self.cells_per_xstep]
+        # Reorder to x-major windows of (channel, block y, block x, cell y, cell x, orient)
+        windows = windows.transpose(2, 1, 0, 6, 7, 3, 4, 5)
+        if index is None:
+            np.copyto(out.reshape(windows.shape), windows)
+        else:
+            np.copyto(out.reshape((len(index),) + windows.shape[2:]),
+                      windows[index // self.nysteps, index % self.nysteps])
+        return out
+
+    # Block ranges (y_start, y_stop, x_start, x_stop) covering the windows at index. Windows
+    # overlapping in x, or less than a block apart, share one range, so a handful of ranges
+    # cover the windows of a vehicle.
+    def block_rects(self, index):
+        x_blocks = np.sort(index // self.nysteps) * self.cells_per_xstep
+        y_blocks = index % self.nysteps * self.cells_per_ystep
+        y_blocks = y_blocks[np.argsort(index // self.nysteps, kind='stable')]
+        rects = []
+        for x_block, y_block in zip(x_blocks, y_blocks):
+            if rects and x_block <= rects[-1][3] + 1:
+                rect = rects[-1]
+                rect[0] = min(rect[0], y_block)
+                rect[1] = max(rect[1], y_block + self.nwinblocks)
+                rect[3] = max(rect[3], x_block + self.nwinblocks)
+            else:
+                rects.append([y_block, y_block + self.nwinblocks, x_block, x_block + self.nwinblocks])
+        return rects
+
+def window_layout(hog_shape, scale, cells_per_xstep, cells_per_ystep, x_origin, y_origin, x_level, y_level):
+    key = (hog_shape, scale, cells_per_xstep, cells_per_ystep, x_origin, y_origin, x_level, y_level)
+    if key not in window_layout_cache:
+        if len(window_layout_cache) >= window_layout_cache_size:
+            window_layout_cache.clear()
+        window_layout_cache[key] = WindowLayout(hog_shape[0], hog_shape[1], scale, cells_per_xstep,
+                                                cells_per_ystep, x_origin, y_origin, x_level, y_level)
+    return window_layout_cache[key]
+
+# Window layout of one scale and search region of a feature pyramid, with its HOG blocks of the
+# channels (first, stop), all by default
+def region_layout(pyramid, scale, cells_per_xstep, cells_per_ystep, x_start, x_stop, y_start, y_stop,
+                  channels=None):
+    # Cached HOG blocks covering the search region and their origin in the scaled level
+    hogs, x_origin, y_origin, x_level, y_level = pyramid.hog_region(scale, x_start, x_stop, y_start, y_stop,
+                                                                    channels=channels)
+    layout = window_layout(hogs.shape[1:3], scale, cells_per_xstep, cells_per_ystep,
+                           x_origin, y_origin, x_level, y_level)
+    return layout, hogs
+
+# Gather the HOG features of every sliding window of one scale and search region from a feature
+# pyramid, as an (n_windows x n_features) float32 matrix, with the window boxes as rows of
+# (x1, y1, x2, y2)
+def window_features(pyramid, scale, cells_per_xstep, cells_per_ystep, x_start, x_stop, y_start, y_stop, out=None):
+    layout, hogs = region_layout(pyramid, scale, cells_per_xstep, cells_per_ystep, x_start, x_stop, y_start, y_stop)
+    if out is None:
+        out = np.empty((layout.n_windows, layout.n_features), dtype=np.float32)
+    return layout.gather(hogs, out), layout.boxes
+
+# Convert rows of (x1, y1, x2, y2) to a list of windows ((x1, y1), (x2, y2))
+def boxes_to_windows(boxes):
+    return [((int(x1), int(y1)), (int(x2), int(y2))) for x1, y1, x2, y2 in boxes]
 
 def add_heatmap(heatmap, heat_thresh, boxes):
     # Iterate through list of bboxes
@@ -191,6 +777,64 @@ def add_heatmap(heatmap, heat_thresh, boxes):
     # Return updated heatmap
     return heatmap
 
+# Running heatmap over the detected windows of the last n_frames frames. Each window adds +1/-1
+# at its four corners of a 2D difference array, so adding or evicting a window costs O(1) and
+# the heatmap is one cumulative sum whatever the history length. The heatmap covers frame rows
+# rows = (y_start, y_stop), or the whole frame, and has the given integer dtype, which must hold
+# the number of windows in history covering one pixel.
+class HeatmapHistory(object):
+    def __init__(self, n_frames, rows=None, dtype=np.int32):
+        self.n_frames = n_frames
+        self.rows = rows
+        self.dtype = dtype
+        # Detected windows of each frame in history as rows of (x1, y1, x2, y2)
+        self.frames = deque()
+        self.shape = None
+        self.diff = None
+        self.heat = None
+        self.y_start = 0
+        self.y_stop = 0
+
+    def reset(self, shape):
+        self.frames.clear()
+        self.shape = shape
+        self.y_start, self.y_stop = self.rows if self.rows is not None else (0, shape[0])
+        self.y_stop = min(self.y_stop, shape[0])
+        self.diff = np.zeros((self.y_stop - self.y_start + 1, shape[1] + 1), dtype=self.dtype)
+        # Heatmap buffer reused by every call to heatmap
+        self.heat = np.empty_like(self.diff)
+
+    def accumulate(self, boxes, sign):
+        if len(boxes) == 0:
+            return
+        height = self.y_stop - self.y_start
+        x1 = np.clip(boxes[:, 0], 0, self.shape[1])
+        y1 = np.clip(boxes[:, 1] - self.y_start, 0, height)
+        x2 = np.clip(boxes[:, 2], 0, self.shape[1])
+        y2 = np.clip(boxes[:, 3] - self.y_start, 0, height)
+        np.add.at(self.diff, (y1, x1), sign)
+        np.add.at(self.diff, (y1, x2), -sign)
+        np.add.at(self.diff, (y2, x1), -sign)
+        np.add.at(self.diff, (y2, x2), sign)
+
+    def update(self, windows, shape):
+        if self.shape != shape:
+            self.reset(shape)
+        # Remove windows of oldest frame if history is full
+        if len(self.frames) == self.n_frames:
+            self.accumulate(self.frames.popleft(), -1)
+        # Assuming each window takes the form ((x1, y1), (x2, y2))
+        boxes = np.array(windows, dtype=np.intp).reshape(-1, 4)
+        self.accumulate(boxes, 1)
+        self.frames.append(boxes)
+
+    def heatmap(self):
+        # Number of windows in history covering each pixel of rows y_start to y_stop, valid until
+        # the next call
+        np.cumsum(self.diff, axis=0, out=self.heat)
+        np.cumsum(self.heat, axis=1, out=self.heat)
+        return self.heat[:self.y_stop - self.y_start, :self.shape[1]]
+
 # Define a function to draw bounding boxes
 def draw_boxes(img_draw, bboxes):
     # Iterate through the bounding boxes
@@ -200,21 +844,101 @@ def draw_boxes(img_draw, bboxes):
     # Return the image copy with boxes drawn
     return img_draw
 
-def draw_labeled_boxes(img_draw, labels):
+# Columns of the region array returned by labeled_regions
+REGION_X1, REGION_Y1, REGION_X2, REGION_Y2, REGION_AREA, REGION_PEAK = range(6)
+
+# Label continuous regions of a thresholded heatmap and return one row per region with its
+# inclusive bounding box, area in pixels and peak heat. Area and peak are computed inside each
+# region's bounding slice only, which stays cheap however large the heatmap is.
+# The heatmap can be max-pooled by downsample before labeling, since the boxes are coarse anyway.
+# A heatmap of a band of frame rows starting at y_offset gives boxes in frame coordinates.
+def labeled_regions(img_heat, downsample=1, y_offset=0):
+    height, width = img_heat.shape
+    if downsample > 1:
+        pooled_height = -(-height // downsample)
+        pooled_width = -(-width // downsample)
+        padded = np.zeros((pooled_height * downsample, pooled_width * downsample), dtype=img_heat.dtype)
+        padded[:height, :width] = img_heat
+        img_heat = padded.reshape(pooled_height, downsample, pooled_width, downsample).max(axis=(1, 3))
+    labels, n_regions = label(img_heat)
+    regions = np.zeros((n_regions, 6), dtype=np.int64)
+    if n_regions == 0:
+        return regions
+    # Bounding slices of every label, then pixel count and peak heat inside each slice only
+    for i, (rows, cols) in enumerate(find_objects(labels)):
+        regions[i, REGION_X1] = cols.start * downsample
+        regions[i, REGION_Y1] = rows.start * downsample + y_offset
+        regions[i, REGION_X2] = min(cols.stop * downsample, width) - 1
+        regions[i, REGION_Y2] = min(rows.stop * downsample, height) - 1 + y_offset
+        region_mask = labels[rows, cols] == i + 1
+        regions[i, REGION_AREA] = np.count_nonzero(region_mask) * downsample ** 2
+        regions[i, REGION_PEAK] = img_heat[rows, cols][region_mask].max()
+    return regions
+
+# Grid in pixels to which regions of interest are snapped
+ROI_GRID = 16
+
+# Merge overlapping search regions of the same scale and steps into their bounding region until
+# none overlap, so each pixel of a scale gets its HOG features computed once
+def merge_search_regions(search_regions):
+    merged = [list(region) for region in search_regions]
+    i = 0
+    while i < len(merged):
+        scale, x_start, x_stop, y_start, y_stop, cells_per_xstep, cells_per_ystep = merged[i]
+        for j in range(i + 1, len(merged)):
+            other = merged[j]
+            if other[0] == scale and other[5:] == [cells_per_xstep, cells_per_ystep] and \
+                    other[1] < x_stop and x_start < other[2] and other[3] < y_stop and y_start < other[4]:
+                merged[i] = [scale, min(x_start, other[1]), max(x_stop, other[2]),
+                             min(y_start, other[3]), max(y_stop, other[4]), cells_per_xstep, cells_per_ystep]
+                del merged[j]
+                # The grown region may now overlap regions already checked
+                i = 0
+                break
+        else:
+            i += 1
+    return [tuple(region) for region in merged]
+
+# Region array, as returned by labeled_regions, with one row per window ((x1, y1), (x2, y2))
+def window_regions(windows):
+    regions = np.zeros((len(windows), 6), dtype=np.int64)
+    for i, ((x1, y1), (x2, y2)) in enumerate(windows):
+        regions[i] = (x1, y1, x2 - 1, y2 - 1, (x2 - x1) * (y2 - y1), 1)
+    return regions
+
+def draw_labeled_boxes(img_draw, regions):
     # Iterate through all detected cars
-    for car_number in range(1, labels[1]+1):
-        # Find pixels with each car_number label value
-        nonzero = (labels[0] == car_number).nonzero()
-        # Identify x and y values of those pixels
-        nonzeroy = np.array(nonzero[0])
-        nonzerox = np.array(nonzero[1])
-        # Define a bounding box based on min/max x and y
-        box = ((np.min(nonzerox), np.min(nonzeroy)), (np.max(nonzerox), np.max(nonzeroy)))
-        # Draw the box on the image
-        cv2.rectangle(img_draw, box[0], box[1], (0,0,255), 3)
+    for region in regions:
+        # Draw the bounding box of each car region on the image
+        cv2.rectangle(img_draw, (int(region[REGION_X1]), int(region[REGION_Y1])),
+                      (int(region[REGION_X2]), int(region[REGION_Y2])), (0,0,255), 3)
     # Return the image
     return img_draw
 
+# Build a detector from the compact model at model_path if there is one, otherwise from the pickled
+# SVM, scaler and cascade stage. export_model.py builds the compact model from the pickles.
+# The cascade stage is only used with use_cascade set.
+# svc_conf_thresh defaults to the threshold saved with the model.
+def load_detector(svc_conf_thresh=None, **kwargs):
+    if os.path.exists(model_path):
+        # Compact model with the scaler folded in and the cascade stage, if one was trained
+        model = load_model(model_path, cascade=use_cascade)
+        if svc_conf_thresh is None:
+            svc_conf_thresh = model['threshold']
+        print('Load model', model_path)
+        return VehicleDetector(model=model, svc_conf_thresh=svc_conf_thresh, **kwargs)
+    from sklearn.externals import joblib
+    # Load pre-trained SVM classifier model
+    svc = joblib.load(svm_model_path)
+    # Load pre-trained per-column scaler
+    X_scaler = joblib.load(scaler_model_path)
+    print('Load SVM and Scaler')
+    # First cascade stage, if one was trained
+    cascade = joblib.load(cascade_model_path) if use_cascade and os.path.exists(cascade_model_path) else None
+    if svc_conf_thresh is None:
+        svc_conf_thresh = classify_vehicles.svc_conf_thresh
+    return VehicleDetector(svc, X_scaler, svc_conf_thresh=svc_conf_thresh, cascade=cascade, **kwargs)
+
 if __name__ == '__main__':
     # Paths to test images and videos
     video_input = 'project_video.mp4'
@@ -225,12 +949,6 @@ if __name__ == '__main__':
     scale_list = [2, 1.5, 1]
     # Number of previous frames over which detected windows are checked
     n_prev_frames = 15
-    # Number of previously detected windows to store for heatmap
-    n_prev_windows = len(scale_list)*n_prev_frames
-    # List of detected windows over n_prev_frames
-    prev_detected_windows = deque(maxlen=n_prev_windows)
-    # Heat map to combine detections over n_prev_frames
-    img_heat_total = np.zeros((720,1280),dtype=np.float)
     # Region in x and y to search in slide_window based on scale
     x_start_stop = [(300, 1280), (400, 1280), (360, 1280)]
     y_start_stop = [(400, 700), (400, 560), (400, 528)]
@@ -238,30 +956,72 @@ if __name__ == '__main__':
     cells_xstep_list = [2, 2, 4]
     cells_ystep_list = [2, 2, 4]
 
-    # Classifier confidence above which detection is true
-    svc_conf_thresh = 1.0
+    # Classifier confidence above which detection is true, None for the threshold saved with the model
+    svc_conf_thresh = None
     # Minumum number of times a pixel is present in a bounding box set to accept detection
     heat_thresh = 7
-    # Load pre-trained SVM classifier model
-    svc = joblib.load(svm_model_path)
-    # Load pre-trained per-column scaler
-    X_scaler = joblib.load(scaler_model_path)
-    print('Load SVM and Scaler')
+    # Heatmap downsampling factor before labeling vehicle regions
+    label_downsample = 1
+    # Non-maximum suppression of detected windows before the heatmap: None, 'scale' or 'cross'
+    nms_mode = None
+    # IoU above which a lower scored window is suppressed
+    nms_iou_thresh = 0.5
+    # Full scan every full_scan_interval frames, or when a vehicle enters, and in between search
+    # only around the vehicles found
+    roi_tracking = False
+    full_scan_interval = 10
+    # Reuse the last detections while the search band changes by less than motion_thresh grey
+    # levels on average, for at most max_skipped_frames frames in a row
+    motion_gating = False
+    motion_thresh = 2.0
+    max_skipped_frames = 2
+    # Frames buffered between the decode, detect and encode stages of the video pipeline
+    video_queue_size = 8
+    # Float32 scoring, int16 heatmap and reused output frames, as many as the video pipeline can
+    # be using at once
+    lean = True
+    output_buffers = output_frames_in_use(video_queue_size)
+    # Per-frame stage timings and window counts, written to profile_output at the end
+    profiler = PipelineProfiler(enabled=True)
+    profile_output = 'pipeline_profile.csv'
+    detector = load_detector(svc_conf_thresh=svc_conf_thresh, scale_list=scale_list,
+                             x_start_stop=x_start_stop, y_start_stop=y_start_stop,
+                             cells_xstep_list=cells_xstep_list, cells_ystep_list=cells_ystep_list,
+                             n_prev_frames=n_prev_frames,
+                             heat_thresh=heat_thresh, label_downsample=label_downsample,
+                             nms_mode=nms_mode, nms_iou_thresh=nms_iou_thresh, roi_tracking=roi_tracking,
+                             full_scan_interval=full_scan_interval, motion_gating=motion_gating,
+                             motion_thresh=motion_thresh, max_skipped_frames=max_skipped_frames,
+                             lean=lean, output_buffers=output_buffers, profiler=profiler)
 
     # Run on video file if true else run on test images
     TEST_ON_VIDEO = True
 
+    # Decode, detect and encode video frames on separate threads instead of moviepy
+    STREAM_VIDEO = True
+    # Detect frames of a recorded video in parallel worker processes, overrides STREAM_VIDEO
+    OFFLINE_VIDEO = False
+    # Worker processes for offline video detection, -1 for all cores
+    n_video_jobs = -1
+
     if TEST_ON_VIDEO == True:
-        # Video is at 25 FPS
-        clip = VideoFileClip(video_input)#.subclip(40,50)
-        clip_output = clip.fl_image(track_vehicles)  # NOTE: this function expects color images!!
-        clip_output.write_videofile(video_output, audio=False)
+        if OFFLINE_VIDEO == True:
+            process_video_offline(video_input, video_output, detector, n_jobs=n_video_jobs)
+        elif STREAM_VIDEO == True:
+            VideoPipeline(video_input, video_output, detector.track_vehicles, queue_size=video_queue_size).run()
+        else:
+            from moviepy.editor import VideoFileClip
+            # Video is at 25 FPS
+            clip = VideoFileClip(video_input)#.subclip(40,50)
+            clip_output = clip.fl_image(detector.track_vehicles)  # NOTE: this function expects color images!!
+            clip_output.write_videofile(video_output, audio=False)
     else:
         if not os.listdir(video_img_dir):
             v_start = 0
             v_end = 1
             video_times = np.linspace(v_start, v_end, 25)
             print(video_times)
+            from moviepy.editor import VideoFileClip
             clip = VideoFileClip(video_input)
             for vt in video_times:
                 video_img_file = video_img_dir + 'video{:3.3}.jpg'.format(vt)
@@ -273,4 +1033,9 @@ if __name__ == '__main__':
         for img_file in img_files:
             img = cv2.imread(img_file)
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            track_vehicles(img, visualise=True)
\ No newline at end of file
+            detector.track_vehicles(img, visualise=True)
+
+    if motion_gating == True:
+        print('Detection rate: {:.2f}'.format(detector.detection_rate()))
+    profiler.print_summary()
+    profiler.dump(profile_output)
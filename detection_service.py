@@ -0,0 +1,246 @@
+import os
+import sys
+import time
+import struct
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Request: request id, frame height, width and channels, stream id length, followed by the stream
+# id in UTF-8 and the raw RGB uint8 frame. A 0x0 frame resets the state of the stream, any other
+# frame without pixels is rejected.
+REQUEST_HEADER = struct.Struct('!IHHBH')
+# Response: request id, status and number of vehicle regions, followed by the regions as big
+# endian int32 rows of (x1, y1, x2, y2, area, peak) like labeled_regions returns them
+RESPONSE_HEADER = struct.Struct('!IBI')
+REGION_DTYPE = np.dtype('>i4')
+# Response status: frame tracked, frame rejected without touching the stream, or tracking failed
+# and the streams of the batch were reset. Only STATUS_OK responses carry regions.
+STATUS_OK = 0
+STATUS_BAD_REQUEST = 1
+STATUS_FAILED = 2
+
+# Unix socket path, or host:port for localhost TCP
+service_address = '/tmp/vehicle_detection.sock'
+# Frames of different streams arriving within max_batch_delay seconds of the first are scored in
+# one batch of at most max_batch_size frames
+max_batch_size = 8
+max_batch_delay = 0.010
+
+# Detection server sharing one detector between clients. Each stream id has its own tracker
+# state in the detector. Frames are micro-batched across clients, one frame per stream per batch
+# so frames of a stream are tracked in order, and run on one worker thread so the event loop keeps
+# reading requests meanwhile. Frames that are not RGB or do not cover the search band are
+# rejected before batching, so they cannot fail the frames of other clients. When a client
+# disconnects, its pending responses are written and the streams it sent are reset.
+class DetectionService(object):
+    def __init__(self, detector, max_batch_size=8, max_batch_delay=0.010):
+        self.detector = detector
+        # Smallest frame width and height holding the search band
+        _, self.min_width, _, self.min_height = detector.search_band()
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.n_batches = 0
+        self.n_frames = 0
+
+    async def handle_client(self, reader, writer):
+        responses = set()
+        stream_ids = set()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(REQUEST_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                request_id, height, width, channels, id_length = REQUEST_HEADER.unpack(header)
+                stream_id = (await reader.readexactly(id_length)).decode()
+                data = await reader.readexactly(height * width * channels)
+                img = np.frombuffer(data, dtype=np.uint8).reshape(height, width, channels)
+                if not height == width == 0 and (channels != 3 or width < self.min_width or
+                                                 height < self.min_height):
+                    write_response(writer, request_id, STATUS_BAD_REQUEST)
+                    continue
+                stream_ids.add(stream_id)
+                future = asyncio.get_running_loop().create_future()
+                await self.queue.put((time.monotonic(), stream_id, img, future))
+                # Requests are pipelined, responses are written as batches complete
+                response = asyncio.ensure_future(self.respond(writer, request_id, future))
+                responses.add(response)
+                response.add_done_callback(responses.discard)
+        finally:
+            # A client that half-closed its side still reads the responses of its pending frames
+            await asyncio.gather(*responses)
+            writer.close()
+            # Resets go through the batcher, after the frames of the client already queued
+            resets = []
+            for stream_id in stream_ids:
+                future = asyncio.get_running_loop().create_future()
+                await self.queue.put((time.monotonic(), stream_id, np.zeros((0, 0, 3), dtype=np.uint8), future))
+                resets.append(future)
+            await asyncio.gather(*resets, return_exceptions=True)
+
+    async def respond(self, writer, request_id, future):
+        try:
+            write_response(writer, request_id, STATUS_OK, await future)
+        except Exception as e:
+            print('Request', request_id, 'failed:', e)
+            write_response(writer, request_id, STATUS_FAILED)
+
+    # Track the frames of one batch on the worker thread and return the regions of each frame.
+    # If tracking fails, the streams of the batch may be partly updated, so they are reset.
+    def process(self, batch):
+        frames = []
+        stream_ids = []
+        for _, stream_id, img, _ in batch:
+            if img.size == 0:
+                self.detector.reset_stream(stream_id)
+            else:
+                frames.append(img)
+                stream_ids.append(stream_id)
+        if frames:
+            try:
+                self.detector.process_batch(frames, stream_ids)
+            except Exception:
+                for stream_id in stream_ids:
+                    self.detector.reset_stream(stream_id)
+                raise
+        return [self.detector.stream(stream_id).regions if img.size else np.zeros((0, 6))
+                for _, stream_id, img, _ in batch]
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        deferred = []
+        while True:
+            pending = deferred if deferred else [await self.queue.get()]
+            deferred = []
+            # Frames queued while the last batch ran join at once, then frames are collected until
+            # the batch is full or the oldest frame used up the latency budget
+            while len(pending) < self.max_batch_size and not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            deadline = pending[0][0] + self.max_batch_delay
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Later frames of a stream already in the batch wait for the next batch
+            batch = []
+            stream_ids = set()
+            for item in pending:
+                if item[1] in stream_ids:
+                    deferred.append(item)
+                else:
+                    stream_ids.add(item[1])
+                    batch.append(item)
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, batch)
+            except Exception as e:
+                for item in batch:
+                    item[3].set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_frames += len(batch)
+            for item, regions in zip(batch, results):
+                item[3].set_result(regions)
+
+async def open_connection(address):
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return await asyncio.open_connection(host, int(port))
+    return await asyncio.open_unix_connection(address)
+
+async def serve(detector, address, max_batch_size=8, max_batch_delay=0.010):
+    service = DetectionService(detector, max_batch_size=max_batch_size, max_batch_delay=max_batch_delay)
+    batcher = asyncio.ensure_future(service.batcher())
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = await asyncio.start_server(service.handle_client, host, int(port))
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = await asyncio.start_unix_server(service.handle_client, path=address)
+    print('Serving on', address)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+        print('Tracked {} frames in {} batches'.format(service.n_frames, service.n_batches))
+
+def write_request(writer, request_id, stream_id, img):
+    stream_id = stream_id.encode()
+    height, width, channels = img.shape
+    writer.write(REQUEST_HEADER.pack(request_id, height, width, channels, len(stream_id)) +
+                 stream_id + np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+
+def write_response(writer, request_id, status, regions=np.zeros((0, 6))):
+    if not writer.is_closing():
+        writer.write(RESPONSE_HEADER.pack(request_id, status, len(regions)) + regions.astype(REGION_DTYPE).tobytes())
+
+async def read_response(reader):
+    request_id, status, n_regions = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+    data = await reader.readexactly(n_regions * 6 * REGION_DTYPE.itemsize)
+    return request_id, status, np.frombuffer(data, dtype=REGION_DTYPE).reshape(n_regions, 6)
+
+# Send n_requests frames of one stream with at most in_flight requests pending, appending the
+# latency of each request to latencies and the id of each request that failed to errors
+async def run_client(address, stream_id, frames, n_requests, in_flight, latencies, errors):
+    reader, writer = await open_connection(address)
+    window = asyncio.Semaphore(in_flight)
+    sent = {}
+
+    async def receive():
+        for _ in range(n_requests):
+            request_id, status, _ = await read_response(reader)
+            if status != STATUS_OK:
+                errors.append(request_id)
+            latencies.append(time.perf_counter() - sent.pop(request_id))
+            window.release()
+
+    receiver = asyncio.ensure_future(receive())
+    for request_id in range(n_requests):
+        await window.acquire()
+        sent[request_id] = time.perf_counter()
+        write_request(writer, request_id, stream_id, frames[request_id % len(frames)])
+        await writer.drain()
+    await receiver
+    writer.close()
+
+# Load generator: n_clients streams sending synthetic frames concurrently. Prints latency
+# percentiles and the frames per second served.
+async def load_generator(address, n_clients=4, n_requests=50, in_flight=1, percentiles=(50, 95, 99)):
+    from benchmark_detection import synthetic_frames
+    frames, _ = synthetic_frames(20)
+    latencies = []
+    errors = []
+    t1 = time.perf_counter()
+    await asyncio.gather(*[run_client(address, 'client{}'.format(i), frames, n_requests, in_flight,
+                                      latencies, errors)
+                           for i in range(n_clients)])
+    t2 = time.perf_counter()
+    latencies = 1000 * np.array(latencies)
+    print('{} clients, {} frames, {} failed, {:.1f} frames/s'.format(n_clients, len(latencies), len(errors),
+                                                                   len(latencies) / (t2 - t1)))
+    print('Latency ms: ' + ' '.join('p{}={:.1f}'.format(p, value)
+                                    for p, value in zip(percentiles, np.percentile(latencies, percentiles))))
+
+if __name__ == '__main__':
+    # detection_service.py [serve|load] [address]
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    address = sys.argv[2] if len(sys.argv) > 2 else service_address
+    if mode == 'serve':
+        from detect_vehicles import load_detector
+        try:
+            asyncio.run(serve(load_detector(), address, max_batch_size=max_batch_size,
+                              max_batch_delay=max_batch_delay))
+        except KeyboardInterrupt:
+            pass
+    elif mode == 'load':
+        asyncio.run(load_generator(address))
+    else:
+        print('Usage: detection_service.py [serve|load] [address]')
@@ -0,0 +1,30 @@
+import os
+import numpy as np
+from classify_vehicles import save_model, image_features, feature_params, svm_model_path, scaler_model_path, \
+    cascade_model_path, model_path, svc_conf_thresh, train_img_width, train_img_height
+
+# Fold already trained pickled models into the compact model read by detect_vehicles, so detection
+# starts without sklearn and without retraining on the dataset. The feature parameters of the
+# current configuration are recorded in the model, so they must be those the pickles were trained
+# with, which is checked against the SVM feature length. A trained cascade stage is exported
+# whether or not use_cascade is set, load_model leaves it out when it is not.
+def export_model(path=model_path, threshold=svc_conf_thresh):
+    from sklearn.externals import joblib
+    svc = joblib.load(svm_model_path)
+    X_scaler = joblib.load(scaler_model_path)
+    params = dict(feature_params())
+    for name in ('train_img_width', 'train_img_height'):
+        params.pop(name)
+    n_features = len(image_features(np.zeros((train_img_height, train_img_width, 3), dtype=np.uint8), **params))
+    if svc.coef_.shape[1] != n_features:
+        raise ValueError('{} has {} features, the configuration gives {}'.format(
+            svm_model_path, svc.coef_.shape[1], n_features))
+    cascade = joblib.load(cascade_model_path) if os.path.exists(cascade_model_path) else None
+    save_model(path, svc, X_scaler, threshold, cascade=cascade)
+    return cascade is not None
+
+if __name__ == '__main__':
+    if export_model():
+        print('Exported', svm_model_path, scaler_model_path, 'and', cascade_model_path, 'to', model_path)
+    else:
+        print('Exported', svm_model_path, 'and', scaler_model_path, 'to', model_path)
@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import multiprocessing
+import numpy as np
+import cv2
+from packed_dataset import PackedDataset, PACKED_IMAGE_SHAPE, dataset_files
+from detect_vehicles import load_detector
+from nms import non_max_suppression_scores
+from classify_vehicles import non_vehicles_dir, packed_dataset_path
+
+# Directories of frames without vehicles to mine, overridden by command line arguments
+mining_dirs = ['./dataset/vehicle_free_frames']
+# Mined crops are appended to the packed dataset if it exists, otherwise written as images to
+# mined_dir, where training and the feature store pick them up as new non-vehicle files
+mined_dir = non_vehicles_dir + '/hard_negatives'
+# Worker processes, -1 for all cores
+n_jobs = -1
+# Accepted windows of a frame overlapping a higher scoring one by more than this IoU are dropped
+mining_iou_thresh = 0.5
+# Crops whose signatures differ in at most this many of their 64 bits are duplicates
+max_signature_distance = 5
+
+# Detector of each pool worker, set once when the worker starts
+worker_detector = None
+
+def init_worker(detector):
+    global worker_detector
+    worker_detector = detector
+
+# Every window of a vehicle-free frame accepted by the detector is a false positive. Overlapping
+# windows are suppressed, keeping the highest scoring one. Return the frame file, the number of
+# windows searched and the kept windows as (box, crop) pairs, with crops resized to the training
+# size in BGR like cv2.imread.
+def mine_frame(file):
+    img = cv2.imread(file)
+    if img is None:
+        return file, 0, []
+    features, boxes = worker_detector.frame_candidates(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    scores = worker_detector.score(features)
+    detected = np.flatnonzero(worker_detector.accept(scores))
+    if len(detected) > 1:
+        detected = detected[non_max_suppression_scores(boxes[detected], scores[detected], mining_iou_thresh)]
+    mined = []
+    for x1, y1, x2, y2 in boxes[detected]:
+        crop = cv2.resize(img[y1:y2, x1:x2], PACKED_IMAGE_SHAPE[1::-1], interpolation=cv2.INTER_AREA)
+        mined.append(((x1, y1, x2, y2), crop))
+    return file, len(boxes), mined
+
+# Difference hash of a crop: signs of horizontal grey level steps on a 9x8 thumbnail packed in a
+# 64 bit integer, so crops differing only by noise or slight shifts have close signatures
+def crop_signature(crop):
+    thumb = cv2.resize(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+    return np.packbits(thumb[:, 1:] > thumb[:, :-1]).view('>u8')[0]
+
+# Number of set bits of every byte value
+byte_bit_counts = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+# Crop signatures, matched within a Hamming distance against all signatures added so far
+class SignatureSet(object):
+    def __init__(self, max_distance=max_signature_distance):
+        self.max_distance = max_distance
+        self.signatures = np.zeros(1024, dtype=np.uint64)
+        self.n_signatures = 0
+
+    # Whether signature is within max_distance bits of an added signature
+    def __contains__(self, signature):
+        if self.n_signatures == 0:
+            return False
+        differing = np.bitwise_xor(self.signatures[:self.n_signatures], np.uint64(signature))
+        distances = byte_bit_counts[differing.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        return distances.min() <= self.max_distance
+
+    def add(self, signature):
+        if self.n_signatures == len(self.signatures):
+            self.signatures = np.concatenate((self.signatures, np.zeros_like(self.signatures)))
+        self.signatures[self.n_signatures] = signature
+        self.n_signatures += 1
+
+# Mine the frames of frame_dirs on a process pool, drop crops whose signatures are within
+# max_signature_distance bits of each other or of the non-vehicles of dataset, and return the
+# kept crops with their source names and the counts# of frames, windows searched and crops mined.
+def mine_negatives(detector, frame_dirs, dataset=None, n_jobs=-1):
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+    files = [file for frame_dir in frame_dirs for file in dataset_files(frame_dir)]
+    seen = SignatureSet()
+    if dataset is not None:
+        images = dataset.images()
+        for start, stop in dataset.chunk_ranges(1024):
+            for crop in images[start:stop][dataset.labels[start:stop] == 0]:
+                seen.add(crop_signature(crop))
+    crops = []
+    sources = []
+    n_windows = 0
+    n_mined = 0
+    with multiprocessing.Pool(n_jobs, initializer=init_worker, initargs=(detector,)) as pool:
+        for file, n_frame_windows, mined in pool.imap_unordered(mine_frame, files, chunksize=4):
+            n_windows += n_frame_windows
+            n_mined += len(mined)
+            for box, crop in mined:
+                signature = crop_signature(crop)
+                if signature in seen:
+                    continue
+                seen.add(signature)
+                crops.append(crop)
+                sources.append('{}:{},{},{},{}'.format(file, *box))
+    return crops, sources, len(files), n_windows, n_mined
+
+if __name__ == '__main__':
+    frame_dirs = sys.argv[1:] or mining_dirs
+    detector = load_detector()
+    dataset = PackedDataset(packed_dataset_path) if os.path.exists(packed_dataset_path + '.index.npz') else None
+    t1 = time.time()
+    crops, sources, n_frames, n_windows, n_mined = mine_negatives(detector, frame_dirs, dataset=dataset,
+                                                                  n_jobs=n_jobs)
+    t2 = time.time()
+    if dataset is not None:
+        dataset.append(np.array(crops).reshape((-1,) + PACKED_IMAGE_SHAPE), np.zeros(len(crops)), sources)
+        print('Appended', len(crops), 'hard negatives to', packed_dataset_path)
+    else:
+        os.makedirs(mined_dir, exist_ok=True)
+        for crop, source in zip(crops, sources):
+            name = source.replace(os.sep, '_').replace(':', '_').replace(',', '_')
+            cv2.imwrite(os.path.join(mined_dir, name + '.png'), crop)
+        print('Wrote', len(crops), 'hard negatives to', mined_dir)
+    elapsed = max(t2 - t1, 1e-9)
+    print('Mined {} frames in {:.1f} s: {:.1f} frames/s, {:.0f} windows/s, {} false positives, {} kept after dedup'.format(
+        n_frames, elapsed, n_frames / elapsed, n_windows / elapsed, n_mined, len(crops)))
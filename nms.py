@@ -57,3 +57,68 @@ def non_max_suppression_fast(boxes, overlapThresh):
 	# return only the bounding boxes that were picked using the
 	# integer data type
 	return boxes[pick].astype("int")
+
+# greedy non-maximum suppression ordered by classifier score, with the
+# pairwise IoU computed in blocks of block_size boxes. boxes are rows of
+# (x1, y1, x2, y2) with exclusive end coordinates. if groups is given,
+# boxes only suppress boxes of the same group (e.g. the same scale),
+# otherwise suppression is across all boxes. returns the indexes of the
+# kept boxes, highest score first
+def non_max_suppression_scores(boxes, scores, iouThresh, groups=None, block_size=64):
+	# if there are no boxes, return an empty list of indexes
+	if len(boxes) == 0:
+		return np.zeros(0, dtype=np.intp)
+
+	# sort the boxes by decreasing score
+	order = np.argsort(-np.asarray(scores), kind="stable")
+	boxes = np.asarray(boxes, dtype=np.float64)[order]
+	if groups is not None:
+		groups = np.asarray(groups)[order]
+	area = (boxes[:,2] - boxes[:,0]) * (boxes[:,3] - boxes[:,1])
+
+	# boxes kept, and boxes not suppressed yet, in score order
+	keep = np.zeros(len(boxes), dtype=bool)
+	alive = np.ones(len(boxes), dtype=bool)
+	for start in range(0, len(boxes), block_size):
+		stop = min(start + block_size, len(boxes))
+		idxs = start + np.flatnonzero(alive[start:stop])
+		if len(idxs) == 0:
+			continue
+
+		# within the block a box i suppresses a lower scored box j
+		# when they overlap, but only if i is itself kept. the greedy
+		# result is the unique fixed point of
+		#   keep[j] = not any(keep[i] and suppress[i, j])
+		# which iterating from all boxes kept reaches in a few steps
+		suppress = np.triu(_overlaps(boxes, area, groups, idxs, idxs, iouThresh), k=1)
+		block_keep = np.ones(len(idxs), dtype=bool)
+		while True:
+			new_keep = ~suppress[block_keep].any(axis=0)
+			if np.array_equal(new_keep, block_keep):
+				break
+			block_keep = new_keep
+		kept = idxs[block_keep]
+		keep[kept] = True
+
+		# suppress the remaining boxes overlapping the boxes just kept,
+		# so later blocks only hold boxes that are still alive
+		rest = stop + np.flatnonzero(alive[stop:])
+		if len(rest) > 0:
+			overlap = _overlaps(boxes, area, groups, kept, rest, iouThresh)
+			alive[rest[overlap.any(axis=0)]] = False
+
+	# return the original indexes of the kept boxes
+	return order[keep]
+
+# pairwise mask of IoU above iouThresh between the boxes at indexes rows
+# and cols, restricted to boxes of the same group
+def _overlaps(boxes, area, groups, rows, cols, iouThresh):
+	r = boxes[rows]
+	c = boxes[cols]
+	w = np.minimum(r[:, None, 2], c[None, :, 2]) - np.maximum(r[:, None, 0], c[None, :, 0])
+	h = np.minimum(r[:, None, 3], c[None, :, 3]) - np.maximum(r[:, None, 1], c[None, :, 1])
+	inter = np.maximum(w, 0) * np.maximum(h, 0)
+	overlap = inter / (area[rows][:, None] + area[cols][None, :] - inter) > iouThresh
+	if groups is not None:
+		overlap &= groups[rows][:, None] == groups[cols][None, :]
+	return overlap
@@ -0,0 +1,89 @@
+import time
+import cv2
+import multiprocessing
+from collections import deque
+
+# Detector of each pool worker, set once when the worker starts
+worker_detector = None
+
+def init_worker(detector):
+    global worker_detector
+    worker_detector = detector
+
+# Detected windows of a frame and, if the detector profiles, the profile record of the search,
+# whose total time is renamed time/worker so it does not clash with the in-order stage
+def detect_frame(img):
+    profiler = worker_detector.profiler
+    profiler.start_frame()
+    windows = worker_detector.detect_windows(img)
+    profiler.end_frame()
+    if not profiler.enabled:
+        return windows, None
+    record = profiler.records.pop()
+    record['time/worker'] = record.pop('time/total')
+    return windows, record
+
+# Process a recorded video with per-frame detection fanned out to a process pool and the
+# temporal stage run in frame order on the returned windows, so the output is identical to
+# running detector.track_vehicles sequentially on the stream stream_id.
+# At most max_pending frames are in flight, which bounds memory on long videos. ROI tracking and
+# motion gating make each search depend on the previous frames, so they are not supported.
+# The profile record of each frame combines the worker search stages and the in-order stages.
+def process_video_offline(video_input, video_output, detector, stream_id=0, n_jobs=-1,
+                          max_pending=None, verbose=True):
+    if detector.roi_tracking or detector.motion_gating:
+        raise ValueError('Offline video detection searches frames independently and does not support '
+                         'roi_tracking or motion_gating')
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = 4 * n_jobs
+    capture = cv2.VideoCapture(video_input)
+    if not capture.isOpened():
+        raise IOError('Cannot open video ' + video_input)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    writer = cv2.VideoWriter(video_output, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        capture.release()
+        raise IOError('Cannot open video writer ' + video_output)
+
+    # Frames submitted for detection, oldest first, with their pending results
+    pending = deque()
+    n_frames = 0
+    t1 = time.time()
+    pool = multiprocessing.Pool(n_jobs, initializer=init_worker, initargs=(detector,))
+    try:
+        end_of_video = False
+        while not end_of_video or pending:
+            # Keep the pool busy up to max_pending frames ahead of the temporal stage
+            while not end_of_video and len(pending) < max_pending:
+                ret, frame = capture.read()
+                if not ret:
+                    end_of_video = True
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                pending.append((frame, pool.apply_async(detect_frame, (frame,))))
+            if not pending:
+                break
+            # Temporal heatmap and labeling in frame order, profiled together with the worker search
+            frame, result = pending.popleft()
+            windows, record = result.get()
+            detector.profiler.start_frame(stream_id)
+            if record is not None:
+                detector.profiler.merge(record)
+            frame_out = detector.track_windows(frame, windows, stream_id=stream_id)
+            detector.profiler.end_frame()
+            writer.write(cv2.cvtColor(frame_out, cv2.COLOR_RGB2BGR))
+            n_frames += 1
+    finally:
+        pool.terminate()
+        pool.join()
+        capture.release()
+        writer.release()
+    t2 = time.time()
+    if verbose:
+        print('Processed {} frames with {} workers at {:.1f} FPS'.format(
+            n_frames, n_jobs, n_frames / max(t2 - t1, 1e-9)))
+    return n_frames
@@ -0,0 +1,120 @@
+import os
+import glob
+import numpy as np
+import cv2
+
+# Shape of every crop in a packed dataset, as read by cv2.imread (BGR)
+PACKED_IMAGE_SHAPE = (64, 64, 3)
+
+# Training crops packed into one contiguous uint8 file of shape (N, 64, 64, 3), read through a
+# memory map, with an index holding the label and source file of every crop. Crops are stored in
+# BGR order like cv2.imread returns them, so features match those extracted from the files.
+# Crops are only ever appended. The index is written after the data, so the crop count in the
+# index is authoritative and a partly written append is discarded by the next one. Source files
+# are only read from the index when needed, to skip files already packed.
+class PackedDataset(object):
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.index.npz'
+        self.image_size = int(np.prod(PACKED_IMAGE_SHAPE))
+        self._sources = None
+        if os.path.exists(self.index_path):
+            with np.load(self.index_path, allow_pickle=False) as index:
+                self.labels = index['labels']
+        else:
+            self.labels = np.zeros(0, dtype=np.int8)
+
+    @property
+    def sources(self):
+        if self._sources is None:
+            if os.path.exists(self.index_path):
+                with np.load(self.index_path, allow_pickle=False) as index:
+                    self._sources = index['sources']
+            else:
+                self._sources = np.zeros(0, dtype=str)
+        return self._sources
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Read-only memory map of all crops
+    def images(self):
+        return packed_images(self.path, len(self))
+
+    # Crops start to stop, mapped from the file
+    def chunk(self, start, stop):
+        return self.images()[start:stop]
+
+    # (start, stop) ranges of at most chunk_size crops covering the dataset
+    def chunk_ranges(self, chunk_size):
+        return [(start, min(start + chunk_size, len(self))) for start in range(0, len(self), chunk_size)]
+
+    # Append crops with their labels and source files. With save_index False the crops are only
+    # kept once save_index is called, so several appends are committed with one index write.
+    def append(self, images, labels, sources, save_index=True):
+        images = np.ascontiguousarray(images, dtype=np.uint8).reshape((-1,) + PACKED_IMAGE_SHAPE)
+        if len(images) == 0:
+            return
+        mode = 'r+b' if os.path.exists(self.path) else 'wb'
+        with open(self.path, mode) as f:
+            # Drop any crops written after the last index update
+            f.truncate(len(self) * self.image_size)
+            f.seek(0, os.SEEK_END)
+            f.write(images.tobytes())
+        self.labels = np.concatenate((self.labels, np.asarray(labels, dtype=np.int8)))
+        self._sources = np.concatenate((self.sources, np.asarray(sources, dtype=str)))
+        if save_index:
+            self.save_index()
+
+    def save_index(self):
+        # Write to a temporary file first so an interrupted save keeps the previous index
+        tmp_path = self.index_path + '.tmp.npz'
+        np.savez(tmp_path, labels=self.labels, sources=self.sources)
+        os.replace(tmp_path, self.index_path)
+
+    # Read image files not packed yet, resize them to the crop size if needed and append them
+    # with label, chunk_size files at a time, writing the index once at the end. Files that cannot
+    # be read are skipped and reported. Returns the number of crops appended.
+    def pack_files(self, files, label, chunk_size=1024):
+        packed = set(self.sources.tolist())
+        files = [file for file in files if file not in packed]
+        n_packed = 0
+        for start in range(0, len(files), chunk_size):
+            chunk_files = []
+            images = np.empty((min(chunk_size, len(files) - start),) + PACKED_IMAGE_SHAPE, dtype=np.uint8)
+            for file in files[start:start + chunk_size]:
+                img = cv2.imread(file)
+                if img is None:
+                    print('Skipping unreadable image', file)
+                    continue
+                if img.shape != PACKED_IMAGE_SHAPE:
+                    img = cv2.resize(img, PACKED_IMAGE_SHAPE[1::-1])
+                images[len(chunk_files)] = img
+                chunk_files.append(file)
+            self.append(images[:len(chunk_files)], np.full(len(chunk_files), label), chunk_files, save_index=False)
+            n_packed += len(chunk_files)
+        if n_packed:
+            self.save_index()
+        return n_packed
+
+# Read-only memory map of the first n_crops crops of the packed data file at path, usable by
+# worker processes without loading the index
+def packed_images(path, n_crops):
+    if n_crops == 0:
+        return np.zeros((0,) + PACKED_IMAGE_SHAPE, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r', shape=(n_crops,) + PACKED_IMAGE_SHAPE)
+
+# Image files of a training directory
+def dataset_files(img_dir):
+    files = []
+    for img_type in ['*.png', '*.jpg']:
+        files.extend(glob.glob(img_dir + '/**/' + img_type, recursive=True))
+    return sorted(files)
+
+if __name__ == '__main__':
+    from classify_vehicles import vehicles_dir, non_vehicles_dir, packed_dataset_path
+    # Pack the vehicle and non-vehicle crops, appending only files not packed yet
+    dataset = PackedDataset(packed_dataset_path)
+    n_cars = dataset.pack_files(dataset_files(vehicles_dir), 1)
+    n_notcars = dataset.pack_files(dataset_files(non_vehicles_dir), 0)
+    print('Packed', n_cars, 'cars and', n_notcars, 'non-cars,', len(dataset), 'crops in', packed_dataset_path)
@@ -0,0 +1,128 @@
+import csv
+import json
+import time
+import numpy as np
+from collections import deque
+
+# Context manager timing one stage of the current frame
+class StageTimer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.t1 = 0.
+
+    def __enter__(self):
+        self.t1 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_time(self.name, time.perf_counter() - self.t1)
+        return False
+
+# Context manager doing nothing, used when profiling is off or no frame is open
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+# Low overhead per-frame profiler of the detection pipeline. Each frame gives one flat record
+# with the frame and stream ids, 'time/<stage>' in seconds and 'count/<name>' counters. Stages
+# repeated within a frame are summed. Only the last max_records frames are kept.
+class PipelineProfiler(object):
+    def __init__(self, enabled=True, max_records=100000):
+        self.enabled = enabled
+        self.records = deque(maxlen=max_records)
+        self.current = None
+        self.n_frames = 0
+        self.t_frame = 0.
+
+    def start_frame(self, stream_id=0):
+        if not self.enabled:
+            return
+        self.current = {'frame': self.n_frames, 'stream': stream_id}
+        self.n_frames += 1
+        self.t_frame = time.perf_counter()
+
+    def end_frame(self):
+        if self.current is None:
+            return
+        self.current['time/total'] = time.perf_counter() - self.t_frame
+        self.records.append(self.current)
+        self.current = None
+
+    def stage(self, name):
+        if self.current is None:
+            return NULL_TIMER
+        return StageTimer(self, name)
+
+    def add_time(self, name, seconds):
+        if self.current is None:
+            return
+        key = 'time/' + name
+        self.current[key] = self.current.get(key, 0.) + seconds
+
+    def count(self, name, n):
+        if self.current is None:
+            return
+        key = 'count/' + name
+        self.current[key] = self.current.get(key, 0) + n
+
+    # Add the stage times and counters of a record made elsewhere, such as a worker process, to
+    # the current frame
+    def merge(self, record):
+        if self.current is None:
+            return
+        for key, value in record.items():
+            if key.startswith('time/') or key.startswith('count/'):
+                self.current[key] = self.current.get(key, 0) + value
+
+    def columns(self):
+        # Union of record keys, ids first then sorted stages and counters
+        keys = set()
+        for record in self.records:
+            keys.update(record)
+        keys.discard('frame')
+        keys.discard('stream')
+        return ['frame', 'stream'] + sorted(keys)
+
+    # Mean and percentiles of every timed stage and counter over the recorded frames. Frames
+    # where a stage did not run count as zero for that stage.
+    def summary(self, percentiles=(50, 95, 99)):
+        summary = {}
+        for key in self.columns()[2:]:
+            values = np.array([record.get(key, 0) for record in self.records], dtype=np.float64)
+            stats = {'mean': values.mean()}
+            for p, value in zip(percentiles, np.percentile(values, percentiles)):
+                stats['p{}'.format(p)] = value
+            summary[key] = stats
+        return summary
+
+    def print_summary(self, percentiles=(50, 95, 99)):
+        if not self.records:
+            return
+        print('Profile over', len(self.records), 'frames (times in ms)')
+        for key, stats in self.summary(percentiles).items():
+            scale = 1000. if key.startswith('time/') else 1.
+            print('{:<24}'.format(key) + ''.join(' {}={:<9.2f}'.format(name, value * scale)
+                                                  for name, value in stats.items()))
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(list(self.records), f)
+
+    def dump_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns(), restval=0)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+    def dump(self, path):
+        # Format chosen by file extension
+        if path.endswith('.json'):
+            self.dump_json(path)
+        else:
+            self.dump_csv(path)
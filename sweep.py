@@ -0,0 +1,160 @@
+import os
+import csv
+import time
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+import cv2
+from packed_dataset import PackedDataset, dataset_files
+from classify_vehicles import extract_features, convert_color, get_hog_features_fast, \
+    vehicles_dir, non_vehicles_dir, packed_dataset_path, feature_store_dir, chunk_size, n_jobs
+
+# Feature parameters to sweep, every combination is one feature configuration
+feature_grid = {'color_space': ['YUV', 'YCrCb', 'LUV'],
+                'orient': [9, 11],
+                'pix_per_cell': [8, 16],
+                'cell_per_block': [2],
+                'hog_channel': ['ALL', 0]}
+# SVM regularisation values fitted on every feature configuration
+C_grid = [0.001, 0.01, 0.1]
+# Fraction of the examples held out for the test accuracy, the same split for all configurations
+test_size = 0.2
+# Scaled features of each configuration, shared with the fitting workers through memory maps
+sweep_dir = './sweep_cache'
+sweep_output = 'sweep_results.csv'
+# Inference cost is measured by computing HOG features on this level of this frame, as
+# (scale, x_start, x_stop, y_start, y_stop), with windows every window_stride pixels
+cost_frame = 'test_images/test1.jpg'
+cost_level = (1.5, 400, 1280, 400, 560)
+window_stride = 16
+n_repeats = 5
+
+# Every combination of the feature grid as extract_features parameters, HOG features only
+def feature_configs(grid):
+    names = sorted(grid)
+    configs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        params = dict(zip(names, values))
+        params.update(use_spatial=False, use_hist=False, use_hog=True)
+        configs.append(params)
+    return configs
+
+def config_key(params):
+    return hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:16]
+
+# Training examples as a PackedDataset or list of image files, with their labels
+def training_set():
+    if os.path.exists(packed_dataset_path + '.index.npz'):
+        dataset = PackedDataset(packed_dataset_path)
+        return dataset, dataset.labels.astype(np.float64)
+    cars = dataset_files(vehicles_dir)
+    notcars = dataset_files(non_vehicles_dir)
+    return cars + notcars, np.hstack((np.ones(len(cars)), np.zeros(len(notcars))))
+
+# Extract the features of one configuration once, scale them with the training split statistics
+# and save the splits for the fitting workers. Returns the feature length and extraction time.
+def prepare_config(params, imgs, y, train_index, test_index):
+    key = config_key(params)
+    t1 = time.time()
+    X = np.vstack(extract_features(imgs, n_jobs=n_jobs, chunk_size=chunk_size,
+                                   store_dir=feature_store_dir, **params)).astype(np.float64)
+    t2 = time.time()
+    mean = X[train_index].mean(axis=0)
+    scale = X[train_index].std(axis=0)
+    scale[scale == 0] = 1.
+    X -= mean
+    X /= scale
+    np.save(os.path.join(sweep_dir, key + '_X_train.npy'), X[train_index])
+    np.save(os.path.join(sweep_dir, key + '_X_test.npy'), X[test_index])
+    np.save(os.path.join(sweep_dir, key + '_y_train.npy'), y[train_index])
+    np.save(os.path.join(sweep_dir, key + '_y_test.npy'), y[test_index])
+    return X.shape[1], t2 - t1
+
+# Fit a linear SVM with regularisation C on the saved features of one configuration
+def fit_config(task):
+    from sklearn.svm import LinearSVC
+    key, C = task
+    X_train = np.load(os.path.join(sweep_dir, key + '_X_train.npy'), mmap_mode='r')
+    X_test = np.load(os.path.join(sweep_dir, key + '_X_test.npy'), mmap_mode='r')
+    y_train = np.load(os.path.join(sweep_dir, key + '_y_train.npy'))
+    y_test = np.load(os.path.join(sweep_dir, key + '_y_test.npy'))
+    svc = LinearSVC(C=C)
+    t1 = time.time()
+    svc.fit(X_train, y_train)
+    t2 = time.time()
+    return key, C, svc.score(X_test, y_test), t2 - t1
+
+# Detection cost per window in microseconds of one configuration: colour conversion, resize and
+# HOG features of the cost level, shared by its windows, plus scoring one window
+def inference_cost(params, frame, feature_length):
+    scale, x_start, x_stop, y_start, y_stop = cost_level
+    pix_per_cell = params['pix_per_cell']
+    cell_per_block = params['cell_per_block']
+    channels = slice(None) if params['hog_channel'] == 'ALL' else \
+        slice(params['hog_channel'], params['hog_channel'] + 1)
+    weights = np.ones(feature_length)
+
+    def level_hog():
+        img_search = convert_color(frame[y_start:y_stop, x_start:x_stop], params['color_space'])
+        img_search = cv2.resize(img_search, (int(img_search.shape[1] / scale), int(img_search.shape[0] / scale)))
+        return get_hog_features_fast(img_search[:, :, channels], params['orient'], pix_per_cell, cell_per_block)
+
+    hogs = level_hog()
+    t1 = time.time()
+    for _ in range(n_repeats):
+        level_hog()
+    t_level = (time.time() - t1) / n_repeats
+    # Windows of the level every window_stride pixels
+    nwinblocks = 64 // pix_per_cell - cell_per_block + 1
+    cells_per_step = max(1, window_stride // pix_per_cell)
+    n_windows = max(1, ((hogs.shape[1] - nwinblocks) // cells_per_step + 1) *
+                    ((hogs.shape[2] - nwinblocks) // cells_per_step + 1))
+    features = np.zeros((n_windows, feature_length))
+    t1 = time.time()
+    for _ in range(n_repeats):
+        features.dot(weights)
+    t_score = (time.time() - t1) / n_repeats
+    return 1e6 * (t_level + t_score) / n_windows
+
+if __name__ == '__main__':
+    os.makedirs(sweep_dir, exist_ok=True)
+    imgs, y = training_set()
+    print('Training set size:', len(y), 'cars:', int(y.sum()))
+    order = np.random.RandomState(0).permutation(len(y))
+    n_test = int(test_size * len(y))
+    test_index = np.sort(order[:n_test])
+    train_index = np.sort(order[n_test:])
+    frame = cv2.imread(cost_frame)
+    if frame is None:
+        frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+
+    # Each feature configuration is extracted once and shared by all its fits
+    configs = {}
+    for params in feature_configs(feature_grid):
+        key = config_key(params)
+        feature_length, extract_time = prepare_config(params, imgs, y, train_index, test_index)
+        configs[key] = dict(params, feature_length=feature_length, extract_time=extract_time,
+                            us_per_window=inference_cost(params, frame, feature_length))
+        print('Extracted', params, feature_length, 'features in {:.1f} s'.format(extract_time))
+
+    # Fits of all configurations and C values run in parallel
+    tasks = [(key, C) for key in configs for C in C_grid]
+    results = []
+    with multiprocessing.Pool(n_jobs if n_jobs > 0 else None) as pool:
+        for key, C, accuracy, train_time in pool.imap_unordered(fit_config, tasks):
+            results.append(dict(configs[key], C=C, accuracy=accuracy, train_time=train_time))
+    results.sort(key=lambda result: -result['accuracy'])
+
+    columns = sorted(feature_grid) + ['C', 'accuracy', 'train_time', 'feature_length',
+                                      'extract_time', 'us_per_window']
+    with open(sweep_output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+    for result in results:
+        print(' '.join('{}={}'.format(name, result[name]) for name in sorted(feature_grid)),
+              'C={} accuracy={:.4f} train={:.2f}s features={} {:.1f}us/window'.format(
+                  result['C'], result['accuracy'], result['train_time'], result['feature_length'],
+                  result['us_per_window']))
+    print('Results written to', sweep_output)
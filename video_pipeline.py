@@ -0,0 +1,163 @@
+import time
+import threading
+import cv2
+from queue import Queue, Empty, Full
+
+# Marker passed down the queues after the last frame
+END_OF_STREAM = None
+
+# Output frames of process_frame a pipeline with queue_size can be using at once: a full queue of
+# detected frames, the frame being encoded and the frame being drawn. A process_frame reusing its
+# output buffers needs at least this many.
+def output_frames_in_use(queue_size):
+    return queue_size + 2
+
+# Throughput counters of one pipeline stage
+class StageCounter(object):
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        # Time spent doing the stage work and time spent blocked on its queues
+        self.busy_time = 0.
+        self.wait_time = 0.
+        self.start_time = None
+        self.stop_time = None
+
+    def fps(self):
+        if self.start_time is None:
+            return 0.
+        elapsed = (self.stop_time or time.time()) - self.start_time
+        return self.frames / elapsed if elapsed > 0 else 0.
+
+    def busy_fps(self):
+        return self.frames / self.busy_time if self.busy_time > 0 else 0.
+
+    def __str__(self):
+        return '{}: {} frames, {:.1f} FPS, {:.1f} FPS busy, {:.2f} s busy, {:.2f} s waiting'.format(
+            self.name, self.frames, self.fps(), self.busy_fps(), self.busy_time, self.wait_time)
+
+# Decode, detect and encode a video in three stages connected by bounded queues. Decoding and
+# encoding run on their own threads and overlap with detection, since OpenCV releases the GIL.
+# A full queue blocks the stage feeding it, so memory stays bounded by queue_size frames.
+class VideoPipeline(object):
+    def __init__(self, video_input, video_output, process_frame, queue_size=8):
+        self.video_input = video_input
+        self.video_output = video_output
+        # Function taking an RGB frame and returning the RGB frame to write
+        self.process_frame = process_frame
+        self.decoded = Queue(maxsize=queue_size)
+        self.detected = Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.decode_counter = StageCounter('Decode')
+        self.detect_counter = StageCounter('Detect')
+        self.encode_counter = StageCounter('Encode')
+
+    def put(self, queue, item, counter):
+        # Block while the next stage is behind, giving up if the pipeline is stopping
+        t1 = time.time()
+        while not self.stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                break
+            except Full:
+                pass
+        counter.wait_time += time.time() - t1
+
+    def get(self, queue, counter):
+        t1 = time.time()
+        while not self.stop_event.is_set():
+            try:
+                item = queue.get(timeout=0.1)
+                counter.wait_time += time.time() - t1
+                return item
+            except Empty:
+                pass
+        counter.wait_time += time.time() - t1
+        return END_OF_STREAM
+
+    def decode(self, capture):
+        counter = self.decode_counter
+        counter.start_time = time.time()
+        try:
+            while not self.stop_event.is_set():
+                t1 = time.time()
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                counter.busy_time += time.time() - t1
+                counter.frames += 1
+                self.put(self.decoded, frame, counter)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+        finally:
+            capture.release()
+            counter.stop_time = time.time()
+            self.put(self.decoded, END_OF_STREAM, counter)
+
+    def encode(self, writer):
+        counter = self.encode_counter
+        counter.start_time = time.time()
+        try:
+            while True:
+                frame = self.get(self.detected, counter)
+                if frame is END_OF_STREAM:
+                    break
+                t1 = time.time()
+                writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+                counter.busy_time += time.time() - t1
+                counter.frames += 1
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+        finally:
+            writer.release()
+            counter.stop_time = time.time()
+
+    def run(self, verbose=True):
+        capture = cv2.VideoCapture(self.video_input)
+        if not capture.isOpened():
+            raise IOError('Cannot open video ' + self.video_input)
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        writer = cv2.VideoWriter(self.video_output, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        if not writer.isOpened():
+            capture.release()
+            raise IOError('Cannot open video writer ' + self.video_output)
+        decoder = threading.Thread(target=self.decode, args=(capture,), name='decoder')
+        encoder = threading.Thread(target=self.encode, args=(writer,), name='encoder')
+        decoder.start()
+        encoder.start()
+        # Detection runs on the calling thread
+        counter = self.detect_counter
+        counter.start_time = time.time()
+        try:
+            while True:
+                frame = self.get(self.decoded, counter)
+                if frame is END_OF_STREAM:
+                    break
+                t1 = time.time()
+                frame_out = self.process_frame(frame)
+                counter.busy_time += time.time() - t1
+                counter.frames += 1
+                self.put(self.detected, frame_out, counter)
+        except BaseException:
+            self.stop_event.set()
+            raise
+        finally:
+            counter.stop_time = time.time()
+            self.put(self.detected, END_OF_STREAM, counter)
+            decoder.join()
+            encoder.join()
+        if self.errors:
+            raise self.errors[0]
+        if verbose:
+            for stage_counter in self.counters():
+                print(stage_counter)
+        return self.counters()
+
+    def counters(self):
+        return self.decode_counter, self.detect_counter, self.encode_counter